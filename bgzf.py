@@ -0,0 +1,514 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+################################################################################
+"""
+Write VCFs out as BGZF (blocked gzip) with a tabix style (.tbi) index, and look
+up the calls in a region across a set of them, all in plain Python with zlib so
+that we don't need htslib installed.  The files we make can be read by bgzip,
+tabix, bcftools, IGV, etc. just the same as if they had made them.
+
+With a list of VCFs, compress and index each one (<vcf>.gz and <vcf>.gz.tbi).
+With '--region', look up which of the indexed VCFs (or those in the directories
+given) have calls in the region, e.g.:
+
+    bgzf.py --region chr7:55019017-55211628 vcfs/
+"""
+import sys
+import os
+import re
+import argparse
+import gzip
+import struct
+import threading
+import zlib
+
+from concurrent.futures import ProcessPoolExecutor
+from termcolor import cprint
+from pprint import pprint as pp  # noqa
+
+version = '1.0.101726'
+
+# Most data that we can put in a block and still be sure it'll fit in 64 KiB
+# once compressed, since the block size has to fit in 16 bits.
+max_block = 0xff00
+bgzf_eof = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000'
+    '000000')
+linear_shift = 14
+max_pos = 1 << 29
+meta_bin = 37450
+
+
+class BgzfWriter(object):
+    """
+    Write BGZF; a series of gzip members of up to 64 KiB each, with the size
+    of each block in a 'BC' extra field so that a reader can jump straight to
+    any block.  tell() gives the virtual offset ((block offset << 16) | offset
+    within the block) of the next byte to be written, which is what goes into
+    the index.
+    """
+    def __init__(self, fh, level=6):
+        self.fh = fh
+        self.level = level
+        self.buffer = bytearray()
+        self.block_offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tell(self):
+        return (self.block_offset << 16) | len(self.buffer)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= max_block:
+            self.__write_block(bytes(self.buffer[:max_block]))
+            del self.buffer[:max_block]
+
+    def __write_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        block = b''.join([
+            struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                ord('B'), ord('C'), 2, 25 + len(cdata)),
+            cdata,
+            struct.pack('<II', zlib.crc32(data), len(data)),
+        ])
+        self.fh.write(block)
+        self.block_offset += len(block)
+
+    def close(self):
+        if self.buffer:
+            self.__write_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.fh.write(bgzf_eof)
+
+
+class BgzfReader(object):
+    """
+    Read a BGZF file (VCF.gz, BAM, etc) from any virtual offset; only the
+    blocks that are actually read get decompressed.
+    """
+    def __init__(self, fh):
+        self.fh = fh
+        self.block_start = None
+        self.next_block = 0
+        self.data = b''
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.fh.close()
+
+    def __load_block(self, offset):
+        self.fh.seek(offset)
+        header = self.fh.read(12)
+        if len(header) < 12:
+            self.block_start, self.next_block = offset, offset
+            self.data, self.pos = b'', 0
+            return False
+        magic, flags, xlen = header[:3], header[3], struct.unpack('<H',
+            header[10:12])[0]
+        if magic != b'\x1f\x8b\x08' or not flags & 4:
+            raise ValueError('Not a BGZF file (bad block header at offset '
+                '{}).'.format(offset))
+        extra = self.fh.read(xlen)
+        bsize = None
+        i = 0
+        while i + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+            if extra[i:i + 2] == b'BC' and slen == 2:
+                bsize = struct.unpack('<H', extra[i + 4:i + 6])[0] + 1
+            i += 4 + slen
+        if bsize is None:
+            raise ValueError('Not a BGZF file (no block size at offset '
+                '{}).'.format(offset))
+        cdata = self.fh.read(bsize - 12 - xlen - 8)
+        self.data = zlib.decompress(cdata, -15)
+        self.block_start = offset
+        self.next_block = offset + bsize
+        self.pos = 0
+        return True
+
+    def seek(self, voffset):
+        coffset, uoffset = voffset >> 16, voffset & 0xffff
+        if coffset != self.block_start:
+            self.__load_block(coffset)
+        self.pos = uoffset
+
+    def tell(self):
+        if self.pos >= len(self.data):
+            return self.next_block << 16
+        return (self.block_start << 16) | self.pos
+
+    def read(self, size):
+        """
+        Read up to size bytes, across blocks as needed.
+        """
+        if self.block_start is None:
+            self.__load_block(0)
+        out = []
+        while size > 0:
+            if self.pos >= len(self.data):
+                if not self.__load_block(self.next_block):
+                    break
+                continue
+            buf = self.data[self.pos:self.pos + size]
+            self.pos += len(buf)
+            size -= len(buf)
+            out.append(buf)
+        return b''.join(out)
+
+    def readline(self):
+        if self.block_start is None:
+            self.__load_block(0)
+        out = []
+        while True:
+            if self.pos >= len(self.data):
+                if not self.__load_block(self.next_block):
+                    break
+                continue
+            end = self.data.find(b'\n', self.pos)
+            if end == -1:
+                out.append(self.data[self.pos:])
+                self.pos = len(self.data)
+                continue
+            out.append(self.data[self.pos:end + 1])
+            self.pos = end + 1
+            break
+        return b''.join(out)
+
+
+def reg2bin(beg, end):
+    """
+    The smallest bin (of the UCSC / SAM binning scheme) that holds the 0-based,
+    half open region beg-end.
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+def reg2bins(beg, end):
+    """
+    All of the bins that could hold records overlapping beg-end.
+    """
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (beg >> shift), offset + (end >> shift) + 1))
+    return bins
+
+def record_span(fields):
+    """
+    0-based, half open span of a VCF record; from POS for the length of REF,
+    or to INFO END for symbolic alleles and the like.
+    """
+    beg = int(fields[1]) - 1
+    end = beg + len(fields[3])
+    if len(fields) > 7:
+        match = re.search(r'(?:^|;)END=(\d+)', fields[7])
+        if match:
+            end = max(end, int(match.group(1)))
+    return beg, max(end, beg + 1)
+
+
+class TabixIndex(object):
+    """
+    Tabix index for a VCF; the bins of chunks and the linear index for each
+    reference sequence, in the order they appear in the file.
+    """
+    def __init__(self):
+        self.names = []
+        self.refs = []
+
+    def add(self, chrom, beg, end, voff_beg, voff_end):
+        if not self.names or self.names[-1] != chrom:
+            self.names.append(chrom)
+            self.refs.append({'bins' : {}, 'linear' : [],
+                'meta' : [voff_beg, voff_end, 0]})
+        ref = self.refs[-1]
+        chunks = ref['bins'].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == voff_beg:
+            chunks[-1][1] = voff_end
+        else:
+            chunks.append([voff_beg, voff_end])
+
+        linear = ref['linear']
+        last = (end - 1) >> linear_shift
+        if len(linear) <= last:
+            linear.extend([None] * (last + 1 - len(linear)))
+        for window in range(beg >> linear_shift, last + 1):
+            if linear[window] is None:
+                linear[window] = voff_beg
+        ref['meta'][1] = voff_end
+        ref['meta'][2] += 1
+
+    def to_bytes(self):
+        names = b''.join(n.encode() + b'\0' for n in self.names)
+        out = [struct.pack('<4s7i', b'TBI\x01', len(self.names), 2, 1, 2, 0,
+            ord('#'), 0), struct.pack('<i', len(names)), names]
+        for ref in self.refs:
+            out.append(struct.pack('<i', len(ref['bins']) + 1))
+            for bin_id, chunks in sorted(ref['bins'].items()):
+                out.append(struct.pack('<Ii', bin_id, len(chunks)))
+                out.extend(struct.pack('<QQ', *c) for c in chunks)
+            voff_beg, voff_end, n_mapped = ref['meta']
+            out.append(struct.pack('<IiQQQQ', meta_bin, 2, voff_beg, voff_end,
+                n_mapped, 0))
+
+            # Empty windows get the offset of the window before them; anything
+            # overlapping them can't start any earlier than that.
+            linear = []
+            for voff in ref['linear']:
+                linear.append(voff if voff is not None else
+                    (linear[-1] if linear else 0))
+            out.append(struct.pack('<i', len(linear)))
+            out.append(struct.pack('<{}Q'.format(len(linear)), *linear))
+        out.append(struct.pack('<Q', 0))
+        return b''.join(out)
+
+    @classmethod
+    def read(cls, tbi_file):
+        with open(tbi_file, 'rb') as fh:
+            data = gzip.decompress(fh.read())
+        if data[:4] != b'TBI\x01':
+            raise ValueError('{} is not a tabix index.'.format(tbi_file))
+        index = cls()
+        n_ref = struct.unpack_from('<i', data, 4)[0]
+        l_nm = struct.unpack_from('<i', data, 32)[0]
+        index.names = [n.decode() for n in data[36:36 + l_nm].split(b'\0')[:n_ref]]
+        pos = 36 + l_nm
+        for _ in range(n_ref):
+            bins = {}
+            n_bin = struct.unpack_from('<i', data, pos)[0]
+            pos += 4
+            for _ in range(n_bin):
+                bin_id, n_chunk = struct.unpack_from('<Ii', data, pos)
+                pos += 8
+                chunks = [list(struct.unpack_from('<QQ', data, pos + 16 * i))
+                    for i in range(n_chunk)]
+                pos += 16 * n_chunk
+                if bin_id != meta_bin:
+                    bins[bin_id] = chunks
+            n_intv = struct.unpack_from('<i', data, pos)[0]
+            linear = list(struct.unpack_from('<{}Q'.format(n_intv), data,
+                pos + 4))
+            pos += 4 + 8 * n_intv
+            index.refs.append({'bins' : bins, 'linear' : linear})
+        return index
+
+    def chunks(self, chrom, beg, end):
+        """
+        The merged, ordered chunks of the file that could hold records
+        overlapping beg-end on chrom.
+        """
+        if chrom not in self.names:
+            return []
+        ref = self.refs[self.names.index(chrom)]
+        linear = ref['linear']
+        min_off = 0
+        if linear:
+            min_off = linear[min(beg >> linear_shift, len(linear) - 1)]
+        chunks = sorted(c for b in reg2bins(beg, end)
+            for c in ref['bins'].get(b, []) if c[1] > min_off)
+        merged = []
+        for chunk_beg, chunk_end in chunks:
+            chunk_beg = max(chunk_beg, min_off)
+            if merged and chunk_beg <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], chunk_end)
+            else:
+                merged.append([chunk_beg, chunk_end])
+        return merged
+
+
+def compress_vcf(vcf_file, outfile=None, level=6):
+    """
+    Write vcf_file out as BGZF (to <vcf_file>.gz by default) along with its
+    tabix index (<outfile>.tbi).  The records need to be grouped by chromosome
+    and sorted by position for the index to work; IR's VCFs are, but if one
+    isn't we sort it as we go.  Returns the name of the compressed file.
+    """
+    if outfile is None:
+        outfile = vcf_file + '.gz'
+
+    header = []
+    records = []
+    with open(vcf_file, 'rb') as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            if line.startswith(b'#'):
+                header.append(line)
+                continue
+            if not line.endswith(b'\n'):
+                line += b'\n'
+            fields = line.decode().rstrip('\n').split('\t', 8)
+            beg, end = record_span(fields)
+            records.append((fields[0], beg, end, line))
+
+    order = {}
+    for chrom, beg, end, line in records:
+        order.setdefault(chrom, len(order))
+    keys = [(order[r[0]], r[1]) for r in records]
+    if any(keys[i] > keys[i + 1] for i in range(len(keys) - 1)):
+        records.sort(key=lambda r: (order[r[0]], r[1]))
+
+    # Workers can be compressing the same VCF at once (e.g. ir_extract.py -j),
+    # so each writes to its own temp files.
+    tmp = '.{}-{}.tmp'.format(os.getpid(), threading.get_ident())
+    index = TabixIndex()
+    with open(outfile + tmp, 'wb') as fh, BgzfWriter(fh, level) as writer:
+        writer.write(b''.join(header))
+        for chrom, beg, end, line in records:
+            voff_beg = writer.tell()
+            writer.write(line)
+            index.add(chrom, beg, end, voff_beg, writer.tell())
+    with open(outfile + '.tbi' + tmp, 'wb') as fh, BgzfWriter(fh) as writer:
+        writer.write(index.to_bytes())
+
+    os.replace(outfile + tmp, outfile)
+    os.replace(outfile + '.tbi' + tmp, outfile + '.tbi')
+    return outfile
+
+def parse_region(region):
+    """
+    Turn a region string (chr, chr:pos, or chr:beg-end, 1-based and inclusive
+    like samtools / tabix) into a 0-based, half open (chrom, beg, end).
+    """
+    match = re.match(r'^([^:]+)(?::([0-9,]+)(?:-([0-9,]+))?)?$', region)
+    if match is None:
+        raise ValueError("'{}' is not a valid region.".format(region))
+    chrom, beg, end = match.groups()
+    beg = int(beg.replace(',', '')) - 1 if beg else 0
+    end = int(end.replace(',', '')) if end else max_pos
+    if beg < 0 or end <= beg:
+        raise ValueError("'{}' is not a valid region.".format(region))
+    return chrom, beg, end
+
+def query(vcf_gz, chrom, beg, end):
+    """
+    Yield the records (as text lines) in an indexed VCF.gz that overlap the
+    0-based, half open region beg-end on chrom.
+    """
+    index = TabixIndex.read(vcf_gz + '.tbi')
+    with BgzfReader(open(vcf_gz, 'rb')) as reader:
+        for chunk_beg, chunk_end in index.chunks(chrom, beg, end):
+            reader.seek(chunk_beg)
+            while reader.tell() < chunk_end:
+                line = reader.readline()
+                if not line:
+                    break
+                fields = line.decode().rstrip('\n').split('\t', 8)
+                if fields[0] != chrom:
+                    break
+                rec_beg, rec_end = record_span(fields)
+                if rec_beg >= end:
+                    return
+                if rec_end > beg:
+                    yield line.decode()
+
+def query_file(vcf_gz, region):
+    """
+    Worker for the process pool; returns the file and the list of records it
+    has in the region.
+    """
+    return vcf_gz, list(query(vcf_gz, *region))
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        'files',
+        nargs='+',
+        metavar='<vcf|dir>',
+        help='VCF file(s) to compress and index, or with "--region", indexed '
+            'VCF.gz files or directories of them to look in.'
+    )
+    parser.add_argument(
+        '-r', '--region',
+        metavar='<chr:beg-end>',
+        help='Look up the calls in this region (1-based, inclusive).'
+    )
+    parser.add_argument(
+        '--records',
+        action='store_true',
+        help='With "--region", print the records found rather than just the '
+            'number of calls in each file.'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<int>',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of files to work on at the same time. Default: '
+            '%(default)s.'
+    )
+    parser.add_argument(
+        '-v', '--version',
+        action='version',
+        version='%(prog)s - v' + version
+    )
+    cli_args = parser.parse_args()
+
+    if cli_args.jobs < 1:
+        sys.stderr.write("ERROR: '--jobs' must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.region:
+        try:
+            cli_args.region = parse_region(cli_args.region)
+        except ValueError as error:
+            sys.stderr.write('ERROR: {}\n'.format(error))
+            sys.exit(1)
+    return cli_args
+
+def main():
+    cli_args = get_args()
+
+    if cli_args.region is None:
+        with ProcessPoolExecutor(max_workers=cli_args.jobs) as pool:
+            for outfile in pool.map(compress_vcf, cli_args.files):
+                sys.stdout.write('Wrote {} and {}.tbi.\n'.format(outfile,
+                    outfile))
+        return
+
+    files = []
+    for path in cli_args.files:
+        if os.path.isdir(path):
+            files.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                if f.endswith('.vcf.gz')
+                and os.path.isfile(os.path.join(path, f + '.tbi'))))
+        else:
+            files.append(path)
+    if not files:
+        sys.stderr.write('ERROR: No indexed VCF.gz files found!\n')
+        sys.exit(1)
+
+    hits = 0
+    with ProcessPoolExecutor(max_workers=cli_args.jobs) as pool:
+        futures = [pool.submit(query_file, f, cli_args.region) for f in files]
+        for future in futures:
+            try:
+                vcf_gz, records = future.result()
+            except (OSError, ValueError) as error:
+                cprint('WARN: {}'.format(error), 'yellow', file=sys.stderr)
+                continue
+            if not records:
+                continue
+            hits += 1
+            sample = os.path.basename(vcf_gz).replace('.vcf.gz', '')
+            if cli_args.records:
+                for record in records:
+                    sys.stdout.write('{}\t{}'.format(sample, record))
+            else:
+                sys.stdout.write('{}\t{}\n'.format(sample, len(records)))
+    sys.stderr.write('{} of {} file(s) have calls in the region.\n'.format(hits,
+        len(files)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+#!/bin/bash
+# Stand-in for irucli.sh to try out ir_cli_sample_creator.py --submit without
+# an IR server.  Checks the sample.list and sample.meta it's given, "uploads"
+# each sample, and exits.  Set these to make it misbehave:
+#
+#   FAKE_IRUCLI_FAIL=<pattern>  Fail any sample.list whose name matches the
+#                               (grep -E) pattern.
+#   FAKE_IRUCLI_FLAKY=<n>       Fail each sample.list the first n times it's
+#                               run (counted in <sample.list>.tries).
+#   FAKE_IRUCLI_DELAY=<secs>    Seconds to take per sample (default 0.1).
+#   FAKE_IRUCLI_EXIT=<code>     Exit code to fail with (default 1).
+################################################################################
+list=''
+meta=''
+while [[ $# -gt 0 ]]; do
+    case "$1" in
+        -s) list="$2"; shift 2 ;;
+        --customParametersFile) meta="$2"; shift 2 ;;
+        *) shift ;;
+    esac
+done
+
+exit_code=${FAKE_IRUCLI_EXIT:-1}
+if [[ ! -f "$list" ]]; then
+    echo "ERROR: sample list '$list' not found!" >&2
+    exit 2
+fi
+if [[ -n "$meta" && ! -f "$meta" ]]; then
+    echo "ERROR: custom parameters file '$meta' not found!" >&2
+    exit 2
+fi
+
+if [[ -n "$FAKE_IRUCLI_FLAKY" ]]; then
+    tries=$(( $(cat "$list.tries" 2>/dev/null || echo 0) + 1 ))
+    echo $tries > "$list.tries"
+    if [[ $tries -le $FAKE_IRUCLI_FLAKY ]]; then
+        echo "ERROR: Connection to server lost (try $tries)." >&2
+        exit $exit_code
+    fi
+fi
+
+grep -v '^#' "$list" | while IFS=, read -r sample rest; do
+    [[ -z "$sample" ]] && continue
+    echo "Uploading $sample..."
+    sleep ${FAKE_IRUCLI_DELAY:-0.1}
+done
+
+if [[ -n "$FAKE_IRUCLI_FAIL" ]] && echo "$list" | grep -qE "$FAKE_IRUCLI_FAIL"; then
+    echo "ERROR: Upload of $list failed." >&2
+    exit $exit_code
+fi
+echo "Upload of $list complete."
@@ -16,21 +16,46 @@ the server, which can be generated using the associated config_gen.py script.
 import sys
 import os
 import io
+import re
 import argparse
+import contextlib
 import json
+import codecs
+import csv
 import requests
 import zipfile
+import hashlib
+import tempfile
 import datetime
+import time
 import progressbar
+import threading
+import random
+import urllib.parse
+import functools
+import collections
 import urllib3
+import sqlite3
+import ir_extract
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from termcolor import cprint
 from pprint import pprint as pp  # noqa
 
-version = '6.3.062920' 
+version = '6.20.101726'
 config_file = os.path.dirname(
         os.path.realpath(__file__)) + '/config/ir_api_retrieve_config.json'
 quiet = False
+segments = 1
+chunk_size = 1024 * 1024
+zero_copy = False
+progress_interval = 0.5
+summary_cache = None
+download_store = None
+extract = False
+extract_patterns = (None, None)
+extract_bgzip = False
+manifest_fields = ('name', 'type', 'size', 'outfile', 'data_link', 'host')
 
 
 class Config(object):
@@ -60,6 +85,332 @@ class Config(object):
         return data
 
 
+@contextlib.contextmanager
+def sqlite_connect(db):
+    '''
+    Open a new SQLite connection for each call so that the database can be 
+    shared between the worker threads. Commits on success and always closes.
+    '''
+    conn = sqlite3.connect(db, timeout=60)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+class SummaryCache(object):
+    """
+    On disk cache of the JSON analysis summaries returned by the IR API, 
+    stored in an SQLite database and keyed on the API URL (i.e. host and 
+    method) and analysis name.  Entries older than the TTL are ignored, and 
+    once the cache grows past its max size, the least recently used entries 
+    are evicted.  With 'refresh', we never read from the cache, but still 
+    store the new results.
+    """
+    def __init__(self, cache_dir, ttl, max_size, refresh=False):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.refresh = refresh
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = os.path.join(cache_dir, 'ir_api_summaries.sqlite')
+        with self.__connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, '
+                'data TEXT, size INTEGER, created REAL, accessed REAL)'
+            )
+
+    def __repr__(self):
+        return '%s:%s' % (self.__class__,self.__dict__)
+
+    def __connect(self):
+        return sqlite_connect(self.db)
+
+    @staticmethod
+    def make_key(url, name):
+        return '{}|{}'.format(url, name)
+
+    def get(self, url, name):
+        if self.refresh:
+            return None
+        key = SummaryCache.make_key(url, name)
+        now = time.time()
+        with self.__connect() as conn:
+            row = conn.execute('SELECT data, created FROM summaries WHERE '
+                'key = ?', (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                return None
+            conn.execute('UPDATE summaries SET accessed = ? WHERE key = ?', 
+                (now, key))
+        return json.loads(row[0])
+
+    def put(self, url, name, json_data):
+        data = json.dumps(json_data)
+        now = time.time()
+        with self.__connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, '
+                '?)', (SummaryCache.make_key(url, name), data, len(data), now, 
+                now))
+            self.__evict(conn, now)
+
+    def __evict(self, conn, now):
+        conn.execute('DELETE FROM summaries WHERE created < ?', 
+            (now - self.ttl,))
+        total = conn.execute('SELECT SUM(size) FROM summaries').fetchone()[0]
+        if not total or total <= self.max_size:
+            return
+        for key, size in conn.execute('SELECT key, size FROM summaries ORDER '
+                'BY accessed').fetchall():
+            conn.execute('DELETE FROM summaries WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+
+class SyncState(object):
+    """
+    State for '--sync' runs, kept per host in an SQLite database; the last day
+    we've listed all the way through, and each analysis we've seen listed, 
+    with a signature of its listing entry and whether we've fetched (and
+    extracted) it yet.  Each run only lists from the last listed day on, and 
+    only retrieves the analyses that are new, have changed (a different 
+    signature), or didn't make it last time.
+    """
+    def __init__(self, db):
+        self.db = db
+        with self.__connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS hosts (host TEXT PRIMARY KEY, '
+                'listed_to TEXT, updated REAL)'
+            )
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS analyses (host TEXT, name TEXT, '
+                'signature TEXT, seen REAL, fetched REAL, extracted INTEGER, '
+                'PRIMARY KEY (host, name))'
+            )
+
+    def __repr__(self):
+        return '%s:%s' % (self.__class__,self.__dict__)
+
+    def __connect(self):
+        return sqlite_connect(self.db)
+
+    @staticmethod
+    def signature(entry):
+        return hashlib.sha1(json.dumps(entry, sort_keys=True).encode(
+            )).hexdigest()
+
+    def listed_to(self, host):
+        with self.__connect() as conn:
+            row = conn.execute('SELECT listed_to FROM hosts WHERE host = ?', 
+                (host,)).fetchone()
+        if row is None:
+            return None
+        return datetime.datetime.strptime(row[0], '%Y-%m-%d').date()
+
+    def set_listed_to(self, host, day):
+        with self.__connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO hosts VALUES (?, ?, ?)', 
+                (host, str(day), time.time()))
+
+    def pending(self, host, extracted=False):
+        """
+        Analyses that were listed on an earlier run, but that we didn't manage
+        to get (or extract).
+        """
+        with self.__connect() as conn:
+            rows = conn.execute('SELECT name FROM analyses WHERE host = ? AND '
+                '(fetched IS NULL OR extracted < ?) ORDER BY seen', (host, 
+                int(extracted))).fetchall()
+        return [row[0] for row in rows]
+
+    def sync_ids(self, host, entries, extracted=False):
+        """
+        Generator of the analysis IDs to retrieve for host; the ones pending 
+        from earlier runs, and then those from the listing entries that are 
+        new or have changed since we last got them.
+        """
+        queued = set()
+        for name in self.pending(host, extracted):
+            queued.add(name)
+            yield name
+
+        for entry in entries:
+            name = entry['name']
+            sig = SyncState.signature(entry)
+            with self.__connect() as conn:
+                row = conn.execute('SELECT signature, fetched, extracted FROM '
+                    'analyses WHERE host = ? AND name = ?', (host, 
+                    name)).fetchone()
+                if row is not None and row[0] == sig:
+                    if row[1] is not None and row[2] >= int(extracted):
+                        continue
+                else:
+                    conn.execute('INSERT OR REPLACE INTO analyses VALUES (?, ?, '
+                        '?, ?, NULL, 0)', (host, name, sig, time.time()))
+            if name not in queued:
+                queued.add(name)
+                yield name
+
+    def done(self, host, name, extracted=False):
+        with self.__connect() as conn:
+            conn.execute('UPDATE analyses SET fetched = ?, extracted = ? WHERE '
+                'host = ? AND name = ?', (time.time(), int(extracted), host, 
+                name))
+
+
+class DownloadStore(object):
+    """
+    Content addressed store of the files we've downloaded.  For each data link
+    we record the ETag, Last-Modified, and size reported by the server along
+    with the SHA-256 of what we got, and keep a hard link to the file under 
+    'objects/' named by that hash.  On the next run we send a conditional 
+    request, and if the server says the data is unchanged, we either skip it 
+    (the file is still where we left it) or link it back into place from the 
+    store rather than downloading it again.
+
+    If the store is on a different filesystem than the download, we can't 
+    hard link into it, so only the metadata is kept and the download is only
+    skipped if the file is still in place.
+    """
+    def __init__(self, store_dir):
+        self.object_dir = os.path.join(store_dir, 'objects')
+        os.makedirs(self.object_dir, exist_ok=True)
+        self.db = os.path.join(store_dir, 'ir_api_downloads.sqlite')
+        with self.__connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS downloads (link TEXT PRIMARY KEY, '
+                'etag TEXT, last_modified TEXT, size INTEGER, sha256 TEXT, '
+                'stored INTEGER, updated REAL)'
+            )
+
+    def __repr__(self):
+        return '%s:%s' % (self.__class__,self.__dict__)
+
+    def __connect(self):
+        return sqlite_connect(self.db)
+
+    def object_path(self, sha256):
+        return os.path.join(self.object_dir, sha256[:2], sha256)
+
+    def lookup(self, data_link):
+        with self.__connect() as conn:
+            row = conn.execute('SELECT etag, last_modified, size, sha256, '
+                'stored FROM downloads WHERE link = ?', (data_link,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('etag', 'last_modified', 'size', 'sha256', 'stored'), 
+            row))
+
+    def check(self, session, data_link, outfile):
+        """
+        Ask the server if the data has changed since we last got it, using a 
+        one byte Range request so that we don't pull the body.  If it hasn't,
+        make sure outfile is in place and return None.  Otherwise return the 
+        validators from the server to pass to add() once we have the file.
+        """
+        record = self.lookup(data_link)
+        headers = {'Range' : 'bytes=0-0'}
+        if record is not None:
+            if record['etag']:
+                headers['If-None-Match'] = record['etag']
+            if record['last_modified']:
+                headers['If-Modified-Since'] = record['last_modified']
+
+        with session.get(data_link, stream=True, headers=headers) as response:
+            validators = {
+                'etag'          : response.headers.get('etag'),
+                'last_modified' : response.headers.get('last-modified'),
+                'size'          : None,
+            }
+            match = re.match(r'bytes \d+-\d+/(\d+)$', 
+                response.headers.get('content-range', ''))
+            if match:
+                validators['size'] = int(match.group(1))
+            elif response.status_code == 200:
+                validators['size'] = response.headers.get('content-length')
+            if response.status_code not in (200, 206, 304):
+                response.raise_for_status()
+
+        if record is None:
+            return validators
+        if response.status_code == 304:
+            unchanged = True
+        elif record['etag'] and validators['etag']:
+            # Some servers ignore the conditional headers, but still give us 
+            # an ETag to compare.
+            unchanged = record['etag'] == validators['etag']
+        elif record['last_modified'] and validators['last_modified']:
+            unchanged = record['last_modified'] == validators['last_modified']
+        elif not any((record['etag'], record['last_modified'], 
+                validators['etag'], validators['last_modified'])):
+            # Server doesn't give us anything to validate with, so all we can 
+            # do is compare sizes.
+            unchanged = (validators['size'] is not None 
+                and int(validators['size']) == record['size'])
+        else:
+            unchanged = False
+
+        if unchanged and self.restore(record, outfile):
+            return None
+        return validators
+
+    def restore(self, record, outfile):
+        """
+        Make sure that outfile is the file we recorded, linking it back from
+        the store if needed.  Returns False if we can't.
+        """
+        obj = self.object_path(record['sha256'])
+        if os.path.isfile(outfile):
+            if record['stored'] and os.path.isfile(obj):
+                if os.path.samefile(outfile, obj):
+                    return True
+            elif os.path.getsize(outfile) == record['size']:
+                return True
+        if not record['stored'] or not os.path.isfile(obj):
+            return False
+        tmp_file = outfile + '.link'
+        if os.path.lexists(tmp_file):
+            os.remove(tmp_file)
+        os.link(obj, tmp_file)
+        os.replace(tmp_file, outfile)
+        return True
+
+    def add(self, data_link, outfile, validators):
+        """
+        Record a completed download, and hard link it into the object store. 
+        If we already have an object with the same content, link outfile to 
+        that one instead so we only keep one copy on disk.
+        """
+        sha = hashlib.sha256()
+        with open(outfile, 'rb') as fh:
+            for buf in iter(lambda: fh.read(chunk_size), b''):
+                sha.update(buf)
+        sha256 = sha.hexdigest()
+        size = os.path.getsize(outfile)
+
+        obj = self.object_path(sha256)
+        stored = True
+        try:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            if os.path.isfile(obj):
+                tmp_file = outfile + '.link'
+                if os.path.lexists(tmp_file):
+                    os.remove(tmp_file)
+                os.link(obj, tmp_file)
+                os.replace(tmp_file, outfile)
+            else:
+                os.link(outfile, obj)
+        except OSError:
+            stored = False
+
+        with self.__connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, '
+                '?, ?, ?)', (data_link, validators['etag'], 
+                validators['last_modified'], size, sha256, int(stored), 
+                time.time()))
+
+
 def get_args():
     parser = argparse.ArgumentParser(description = __doc__)
     parser.add_argument(
@@ -71,7 +422,16 @@ def get_args():
         '-H', '--Host', 
         metavar="<server_hostname>",
         help="Hostname of server from which to gather data. Use '?' to print "
-            "out all valid hosts as defined in your config file."
+            "out all valid hosts as defined in your config file. Can be a "
+            "comma separated list of hosts to pull from all of them at once "
+            "(with '--date-range'), in which case the files are named for the "
+            "host too (e.g. <host>_<id>_download.zip)."
+    )
+    parser.add_argument(
+        '--all-hosts',
+        action='store_true',
+        help='Pull from all of the hosts in the config file at once (with '
+            '"--date-range").'
     )
     parser.add_argument(
         '-b','--batch', 
@@ -113,10 +473,182 @@ def get_args():
         help='Range of dates in the format of "start,end" where each date is in '
         'the format YYYY-MM-dd. This will be the range which will be used to '
         'pull out results. One can input only 1 date if the range is only going '
-        'to be one day. Note that this method is a bit slow as every run seems '
-        'to be checked for inclusion, as well, as the fact that anything within '
-        'the range will be downloaded. So, choose this method only if it is '
-        'faster than just simply copy / pasting a discrete list of IDs you want!'
+        'to be one day. The range is listed a window of days at a time (see '
+        '"--window-days"), and downloads start as soon as the first results '
+        'are listed. Note that anything within the range will be downloaded!'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<int>',
+        type=int,
+        default=1,
+        help='Number of analyses to retrieve at the same time. When more than '
+            'one job is run, a single combined progress display is output '
+            'rather than one progress bar per file. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '-s', '--segments',
+        metavar='<int>',
+        type=int,
+        default=1,
+        help='Number of byte ranges of an RNA or DNA BAM file to download at '
+            'the same time. Falls back to a single stream if the server does '
+            'not report the file size. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--chunk-size',
+        metavar='<MiB>',
+        type=float,
+        default=1,
+        help='Size of the chunks, in MiB, to read from the server and write to '
+            'disk at a time. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--zero-copy',
+        action='store_true',
+        help='Read the raw socket data into one reused buffer rather than '
+            'making a new object for each chunk. Only used for downloads that '
+            'are not content-encoded by the server.'
+    )
+    parser.add_argument(
+        '--pool-size',
+        metavar='<int>',
+        type=int,
+        help='Number of keep-alive connections to hold open to the IR server '
+            'for the whole batch. (DEFAULT: the larger of 10 or the number of '
+            'jobs times the number of segments)'
+    )
+    parser.add_argument(
+        '--retries',
+        metavar='<int>',
+        type=int,
+        default=4,
+        help='Number of times to retry a request that fails to connect, gets '
+            'a transient error from the server (e.g. 502, 503), or drops '
+            'partway through a download. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--max-delay',
+        metavar='<seconds>',
+        type=float,
+        default=60,
+        help='Longest time to wait between retries. The wait grows '
+            'exponentially with a random jitter up to this limit. (DEFAULT: '
+            '%(default)s)'
+    )
+    parser.add_argument(
+        '--host-limit',
+        metavar='<int>',
+        type=int,
+        help='Most requests to have in flight to an IR server at once, across '
+            'all jobs and segments. (DEFAULT: no limit)'
+    )
+    parser.add_argument(
+        '--failed-file',
+        metavar='<file>',
+        help='File to which to write anything that failed permanently, so it '
+            'can be run again with "--batch" (or "--fetch" for a manifest). '
+            '(DEFAULT: failed_analyses.txt, or <manifest>.failed for a '
+            'manifest)'
+    )
+    parser.add_argument(
+        '--resolve',
+        metavar='<manifest>',
+        help='Only resolve the data links and sizes for the analyses, and '
+            'write them to a manifest file (TSV if the name ends in ".tsv", '
+            'JSON otherwise) to be downloaded later with "--fetch".'
+    )
+    parser.add_argument(
+        '--fetch',
+        metavar='<manifest>',
+        help='Download the files listed in a manifest file made with '
+            '"--resolve", rather than looking up analysis IDs.'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        metavar='<dir>',
+        default=os.path.join(os.environ.get('XDG_CACHE_HOME', 
+            os.path.expanduser('~/.cache')), 'ir_utils'),
+        help='Directory in which to keep the cache of analysis summaries. '
+            '(DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        metavar='<hours>',
+        type=float,
+        default=24,
+        help='Number of hours for which a cached analysis summary is used '
+            'before getting it from the server again. Use 0 to turn off the '
+            'cache. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--cache-max-size',
+        metavar='<MiB>',
+        type=float,
+        default=100,
+        help='Size in MiB past which the least recently used analysis '
+            'summaries are evicted from the cache. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        help='Ignore the cached analysis summaries and get them from the '
+            'server again.'
+    )
+    parser.add_argument(
+        '--extract',
+        action='store_true',
+        help='Unpack each VCF download straight into a directory for each '
+            'sample and collect the VCFs into a "vcfs" directory, like '
+            'ir_extract.py does, rather than writing out the download ZIP. '
+            'The download is held in memory (or a temp file if it is large) '
+            'until it can be unpacked, so an interrupted download starts over '
+            'rather than resuming.'
+    )
+    parser.add_argument(
+        '--vcf-only',
+        action='store_true',
+        help='With "--extract", only unpack the VCFs that get collected into '
+            'the "vcfs" directory, and skip everything else in the download.'
+    )
+    parser.add_argument(
+        '--bgzip',
+        action='store_true',
+        help='With "--extract", also write a BGZF compressed copy of each '
+            'collected VCF with a tabix index.'
+    )
+    parser.add_argument(
+        '--store',
+        metavar='<dir>',
+        help='Keep a content addressed store of downloads in this directory, '
+            'and skip (or link back into place) any file that the server '
+            'reports has not changed since the last time it was downloaded. '
+            'Needs to be on the same filesystem as the downloads to be able '
+            'to link files back into place.'
+    )
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='Only retrieve the analyses that are new or have changed since the '
+            'last sync of each host, along with any that failed last time. The '
+            'state is kept in the "--sync-db" database; the first sync of a '
+            'host needs a "--date-range" to know where to start from.'
+    )
+    parser.add_argument(
+        '--sync-db',
+        metavar='<db_file>',
+        default='ir_api_sync.sqlite',
+        help='SQLite database to keep the "--sync" state in. (DEFAULT: '
+            '%(default)s)'
+    )
+    parser.add_argument(
+        '--window-days',
+        metavar='<int>',
+        type=int,
+        default=7,
+        help='When using "--date-range", list the results this many days at a '
+            'time, and start downloading as soon as the first results are '
+            'listed. (DEFAULT: %(default)s)'
     )
     parser.add_argument(
         '-q', '--quiet',
@@ -130,7 +662,7 @@ def get_args():
     )
     cli_args = parser.parse_args()
 
-    if not cli_args.Host:
+    if not cli_args.Host and not cli_args.all_hosts:
         if cli_args.ip and not cli_args.token:
             sys.stderr.write("ERROR: You must enter a custom token with the '-t'"
                 " option if you are using a custom IP.\n")
@@ -143,11 +675,63 @@ def get_args():
             sys.stderr.write("ERROR: You must either enter a host name or a custom "
                 "IP and token!\n")
             sys.exit(1)
+    if cli_args.resolve and cli_args.fetch:
+        sys.stderr.write("ERROR: The '--resolve' and '--fetch' options can not "
+            "be used together.\n")
+        sys.exit(1)
+    if cli_args.extract and (cli_args.rna or cli_args.dna):
+        sys.stderr.write("ERROR: Only VCF data can be extracted with "
+            "'--extract'.\n")
+        sys.exit(1)
+    if cli_args.vcf_only and not cli_args.extract:
+        sys.stderr.write("ERROR: The '--vcf-only' option can only be used with "
+            "'--extract'.\n")
+        sys.exit(1)
+    if cli_args.bgzip and not cli_args.extract:
+        sys.stderr.write("ERROR: The '--bgzip' option can only be used with "
+            "'--extract'.\n")
+        sys.exit(1)
+    if cli_args.extract and cli_args.resolve:
+        sys.stderr.write("ERROR: The '--resolve' and '--extract' options can "
+            "not be used together.\n")
+        sys.exit(1)
+    if cli_args.extract and cli_args.store:
+        # There's no download ZIP to keep in the store.
+        sys.stderr.write("ERROR: The '--store' and '--extract' options can "
+            "not be used together.\n")
+        sys.exit(1)
+    if cli_args.sync and (cli_args.resolve or cli_args.fetch or cli_args.batch
+            or cli_args.analysis_id):
+        sys.stderr.write("ERROR: The '--sync' option can not be used with "
+            "'--resolve', '--fetch', or a list of analysis IDs.\n")
+        sys.exit(1)
+    if cli_args.window_days < 1:
+        sys.stderr.write("ERROR: The listing window must be at least 1 day.\n")
+        sys.exit(1)
+    if cli_args.retries < 0:
+        sys.stderr.write("ERROR: The number of retries can not be negative.\n")
+        sys.exit(1)
+    if cli_args.host_limit is not None and cli_args.host_limit < 1:
+        sys.stderr.write("ERROR: The host limit must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.jobs < 1:
+        sys.stderr.write("ERROR: The number of jobs must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.segments < 1:
+        sys.stderr.write("ERROR: The number of segments must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.chunk_size <= 0:
+        sys.stderr.write("ERROR: The chunk size must be greater than 0.\n")
+        sys.exit(1)
+    if cli_args.pool_size is not None and cli_args.pool_size < 1:
+        sys.stderr.write("ERROR: The connection pool size must be at least "
+            "1.\n")
+        sys.exit(1)
     return cli_args
 
 def __validate_date(date):
     try:
-        datetime.datetime.strptime(date, '%Y-%M-%d')
+        return datetime.datetime.strptime(date, '%Y-%m-%d').date()
     except ValueError:
         sys.stderr.write("ERROR: the date '%s' is not in a valid format. "
             "You must use YYYY-MM-dd.\n" % date)
@@ -174,6 +758,28 @@ def get_host(hostname, hostdata=None):
             sys.exit(1)
     return ip, token
 
+def get_hosts(cli_args):
+    """
+    Return a list of (name, API URL, token) for each of the servers we're 
+    going to work with; a custom IP and token, a comma separated list of 
+    hosts from the config file, or all of them.
+    """
+    if cli_args.ip and cli_args.token:
+        return [(cli_args.ip, format_url(cli_args.ip) + '/api/v1/', 
+            cli_args.token)]
+
+    program_config = Config.read_config(config_file)
+    if cli_args.all_hosts:
+        names = sorted(program_config['hosts'])
+    else:
+        names = [h for h in cli_args.Host.split(',') if h]
+
+    hosts = []
+    for name in names:
+        server_url, api_token = get_host(name, program_config['hosts'])
+        hosts.append((name, server_url + '/api/v1/', api_token))
+    return hosts
+
 def format_url(ip):
     pieces = ip.lstrip('https://').split('.')
     if len(pieces) != 4: 
@@ -187,6 +793,170 @@ def format_url(ip):
             "appear to be valid!\n".format(ip))
         sys.exit(1)
 
+class IncompleteDownload(requests.exceptions.RequestException):
+    '''The server closed the download before we had the whole file.'''
+    pass
+
+
+class RetryPolicy(object):
+    """
+    How many times to retry a failed request, and how long to wait between
+    tries. The delay grows exponentially from base_delay up to max_delay, with
+    full jitter so that a batch of workers that failed together don't all come
+    back at the same time.
+    """
+    retry_statuses = (429, 500, 502, 503, 504)
+
+    def __init__(self, retries=4, max_delay=60, base_delay=1):
+        self.retries = retries
+        self.max_delay = max_delay
+        self.base_delay = base_delay
+
+    def __repr__(self):
+        return '%s:%s' % (self.__class__,self.__dict__)
+
+    def delay(self, attempt, retry_after=None):
+        if retry_after is not None and retry_after.isdigit():
+            return min(int(retry_after), self.max_delay)
+        return random.uniform(0, min(self.max_delay, 
+            self.base_delay * 2 ** attempt))
+
+    def warn(self, error, url, attempt, wait):
+        if quiet is False:
+            cprint('WARN: ', 'yellow', attrs=['bold'], end='', file=sys.stderr)
+            sys.stderr.write('{} for {}; retrying in {:.1f}s (attempt {} of '
+                '{}).\n'.format(error, url, wait, attempt + 1, self.retries))
+
+
+class IRSession(requests.Session):
+    """
+    Session that retries requests that fail to connect or get a transient 
+    error status (e.g. 502 / 503) from the server, using a RetryPolicy, and 
+    that caps the number of requests in flight to each host.  A streamed 
+    response holds its slot until it's closed.
+
+    If we run out of retries on a connection error, the error is raised with 
+    a 'retried' attribute set so that callers know not to retry it again. 
+    If we run out on an error status, the response is returned as is for the 
+    caller to deal with.
+    """
+    def __init__(self, policy, host_limit=None):
+        super().__init__()
+        self.policy = policy
+        self.host_limit = host_limit
+        self.host_slots = {}
+        self.slot_lock = threading.Lock()
+
+    def __host_slot(self, url):
+        if not self.host_limit:
+            return None
+        host = urllib.parse.urlsplit(url).netloc
+        with self.slot_lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(
+                    self.host_limit)
+            return self.host_slots[host]
+
+    @staticmethod
+    def __hold_slot(response, slot):
+        # Release the slot when the caller closes the streamed response.
+        close = response.close
+        released = []
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                if not released:
+                    released.append(True)
+                    slot.release()
+        response.close = close_and_release
+
+    def request(self, method, url, *args, **kwargs):
+        slot = self.__host_slot(url)
+        attempt = 0
+        while True:
+            if slot is not None:
+                slot.acquire()
+            try:
+                response = super().request(method, url, *args, **kwargs)
+            except (requests.exceptions.ConnectionError, 
+                    requests.exceptions.Timeout) as error:
+                if slot is not None:
+                    slot.release()
+                if attempt >= self.policy.retries:
+                    error.retried = True
+                    raise
+                wait = self.policy.delay(attempt)
+                self.policy.warn(error, url, attempt, wait)
+            except BaseException:
+                if slot is not None:
+                    slot.release()
+                raise
+            else:
+                if (response.status_code in self.policy.retry_statuses 
+                        and attempt < self.policy.retries):
+                    wait = self.policy.delay(attempt, 
+                        response.headers.get('retry-after'))
+                    self.policy.warn('HTTP {}'.format(response.status_code), 
+                        url, attempt, wait)
+                    response.close()
+                    if slot is not None:
+                        slot.release()
+                elif slot is None:
+                    return response
+                elif kwargs.get('stream'):
+                    IRSession.__hold_slot(response, slot)
+                    return response
+                else:
+                    slot.release()
+                    return response
+            time.sleep(wait)
+            attempt += 1
+
+
+def with_retries(session, what, func, *args):
+    """
+    Call func(*args) for 'what' (an analysis ID or file name), and start it 
+    over if the connection drops partway through a response body, or a 
+    download comes up short.  Since downloads pick up from the partial file, 
+    we don't lose what we already have.  Errors that the session already 
+    retried, and HTTP errors from the server, are passed straight on.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except (requests.exceptions.ConnectionError, 
+                requests.exceptions.ChunkedEncodingError,
+                requests.exceptions.Timeout, IncompleteDownload) as error:
+            if (getattr(error, 'retried', False) 
+                    or attempt >= session.policy.retries):
+                raise
+            wait = session.policy.delay(attempt)
+            session.policy.warn(error, what, attempt, wait)
+            time.sleep(wait)
+            attempt += 1
+
+def make_session(header, pool_size, policy, host_limit=None):
+    """
+    Set up one keep-alive session to be shared by every request in the batch
+    so that we're not doing a new TCP and TLS handshake to the IR server for 
+    each analysis ID.  The pool size is the number of connections that will be
+    held open to each host, and the host limit the number of requests that can
+    be in flight to each host at once.
+    """
+    urllib3.disable_warnings()
+    session = IRSession(policy, host_limit)
+    session.headers.update(header)
+    session.verify = False
+
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+        pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def jdump(json_data):
     print(json.dumps(json_data, indent=4, sort_keys=True))
 
@@ -194,7 +964,7 @@ def proc_batchfile(batchfile):
     with open(batchfile) as fh:
         return [line.rstrip() for line in fh if line != '\n']
 
-def make_bam_datalink(na_type, run_summary, session, header):
+def make_bam_datalink(na_type, run_summary, session):
     """
     Have to get the DNA or RNA BAM file name, which is going to be stored in an 
     RRS file that contains the sample name. 
@@ -217,10 +987,8 @@ def make_bam_datalink(na_type, run_summary, session, header):
 
     rrs_file = ir_sample_name + '.rrs'
 
-    response = session.get(data_dir + '/' + rrs_file, headers=header,
-        verify=False)
-    z = zipfile.ZipFile(io.BytesIO(response.content))
-    data = z.read(rrs_file).decode('ascii')
+    data = read_remote_zip_member(session, data_dir + '/' + rrs_file, 
+        rrs_file).decode('ascii')
     elems = data.split()
     
     if na_type == 'RNA':
@@ -232,75 +1000,635 @@ def make_bam_datalink(na_type, run_summary, session, header):
         api_path = '{}={}'.format(data_dir.split('=')[0], dna_bam)
         return api_path
 
-def api_call(url, query, header, batch_type, get_rna, get_dna, name=None):
-    global quiet 
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object for a file on the server, where each read
+    is an HTTP Range request for just the bytes asked for.  Wrapped in a 
+    BufferedReader, this lets zipfile read the central directory and the one 
+    member that we want without pulling down the rest of the archive.
+    """
+    def __init__(self, session, url, size):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.pos = 0
 
-    urllib3.disable_warnings()
-    s = requests.Session()
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        return self.pos
+
+    def readinto(self, buf):
+        if self.pos >= self.size or len(buf) == 0:
+            return 0
+        end = min(self.pos + len(buf), self.size) - 1
+        response = self.session.get(self.url, 
+            headers={'Range' : 'bytes={}-{}'.format(self.pos, end)})
+        if response.status_code != 206:
+            raise requests.exceptions.HTTPError('Server did not return the '
+                'byte range {}-{} of {} (status {}).'.format(self.pos, end, 
+                self.url, response.status_code), response=response)
+        data = response.content
+        buf[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+def read_remote_zip_member(session, url, member):
+    """
+    Read one member out of a ZIP archive on the server.  If the server gives
+    us byte ranges, only the end of central directory record, the central 
+    directory, and the member itself are read.  If not, stream the archive to
+    a temp file and read it from there rather than holding the whole thing in
+    memory.
+    """
+    size = get_remote_size(session, url)
+    if size:
+        raw = HTTPRangeFile(session, url, size)
+        with io.BufferedReader(raw, buffer_size=64 * 1024) as fh, \
+                zipfile.ZipFile(fh) as z:
+            return z.read(member)
+
+    with tempfile.TemporaryFile() as tmp, \
+            session.get(url, stream=True) as response:
+        response.raise_for_status()
+        for buf in iter_chunks(response):
+            tmp.write(buf)
+        tmp.seek(0)
+        with zipfile.ZipFile(tmp) as z:
+            return z.read(member)
 
+def get_summary(url, query, session, get_rna, get_dna):
+    """
+    Get the JSON analysis summary for an analysis ID from the API, using the
+    summary cache if we have one.  Returns None if the server gave us an error.
+    """
     # If we want to get RNA files, we need to get the officially entered RNA 
     # name, which means we need to get a summary call.
     if get_rna or get_dna:
         url = url.replace('getvcf', 'analysis')
 
-    request = s.get(url, headers=header, params=query, verify=False)
+    json_data = None
+    if summary_cache is not None:
+        json_data = summary_cache.get(url, query['name'])
 
-    try:
-        request.raise_for_status()
-    except requests.exceptions.HTTPError as error:
-        cprint('\n\n\t{}'.format(error), 'red', attrs=['bold'], file=sys.stderr)
-        if batch_type == 'range':
-            cprint('\tThere may be no data available for the range input. Check '
-                'the date range and try again.\n','red', 
-                attrs=['bold'], file=sys.stderr)
-        else:
+    if json_data is None:
+        request = session.get(url, params=query)
+
+        try:
+            request.raise_for_status()
+        except requests.exceptions.HTTPError as error:
+            cprint('\n\n\t{}'.format(error), 'red', attrs=['bold'], 
+                file=sys.stderr)
             cprint('\tSkipping analysis id: %s. Check ID for this run and try '
-                'again.\n' % query['name'], 'red', attrs=['bold'], file=sys.stderr)
-        return None
+                'again.\n' % query['name'], 'red', attrs=['bold'], 
+                file=sys.stderr)
+            return None
+
+        json_data = request.json()
+        if summary_cache is not None:
+            summary_cache.put(url, query['name'], json_data)
+    return json_data
+
+def date_windows(start, end, days):
+    """
+    Split the start to end date range up into windows of so many days, each 
+    of which we can list separately.
+    """
+    while start <= end:
+        window_end = min(start + datetime.timedelta(days=days - 1), end)
+        yield start, window_end
+        start = window_end + datetime.timedelta(days=1)
+
+def iter_json_array(response):
+    """
+    Parse the JSON list in a streamed response a piece at a time, yielding 
+    each element as soon as we've read all of it, rather than loading the 
+    whole body into memory with response.json() first.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    started = False
+
+    for chunk in response.iter_content(chunk_size):
+        buf = buf[pos:] + text.decode(chunk)
+        pos = 0
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos == len(buf):
+                break
+            elif not started:
+                if buf[pos] != '[':
+                    raise ValueError('Expected a JSON list from the API, but '
+                        'got: {}'.format(buf[pos:pos+80]))
+                started = True
+                pos += 1
+            elif buf[pos] == ',':
+                pos += 1
+            elif buf[pos] == ']':
+                return
+            else:
+                try:
+                    element, pos = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # Don't have the whole element yet.
+                    break
+                yield element
+    raise ValueError('Incomplete JSON list in the API response.')
+
+def list_range(url, session, start, end, window, get_rna, get_dna, 
+        entries=False, failed=None):
+    """
+    Generator of the analysis IDs with results in the start to end date range.
+    Rather than asking for the whole range at once and waiting for one giant 
+    response, list it a window of days at a time, so that downloads can start
+    while later windows are still being listed.  Each window is read in full 
+    and its response closed before any of its IDs are yielded, so that the
+    listing doesn't hold a connection (or a --host-limit slot) while the 
+    caller downloads them.
+
+    With entries, yield the whole listing entry for each analysis rather than
+    just the ID.  Any windows we couldn't list are added to the failed list, 
+    if we're given one.
+    """
+    if get_rna or get_dna:
+        url = url.replace('getvcf', 'analysis')
 
-    json_data = request.json()
+    for win_start, win_end in date_windows(start, end, window):
+        query = {
+            'format' : 'json', 
+            'start_date' : str(win_start), 
+            'end_date' : str(win_end), 
+            'exclude' : 'filteredvariants' 
+        }
+        try:
+            with session.get(url, params=query, stream=True) as response:
+                response.raise_for_status()
+                analyses = list(iter_json_array(response))
+        except (requests.exceptions.RequestException, ValueError) as error:
+            if failed is not None:
+                failed.append((win_start, win_end))
+            cprint('\n\t{}\n\tUnable to list results for dates from {} to {}.'
+                ' There may be no data available for this range.\n'.format(
+                error, win_start, win_end), 'red', attrs=['bold'], 
+                file=sys.stderr)
+            continue
 
-    if batch_type == 'range':
         if quiet is False:
-            sys.stdout.write('Done!\n')
-            sys.stdout.write('Total number to retrieve: %s.\n' % len(json_data))
+            sys.stdout.write('Listed {} results for dates from {} to {}.\n'.format(
+                len(analyses), win_start, win_end))
             sys.stdout.flush()
-        return [x['name'] for x in json_data]
+        for analysis in analyses:
+            yield analysis if entries else analysis['name']
+
+def get_data_link(analysis_set, session, get_rna, get_dna):
+    if get_rna:
+        return make_bam_datalink('RNA', analysis_set, session)
+    elif get_dna:
+        return make_bam_datalink('DNA', analysis_set, session)
+    else:
+        return analysis_set['data_links']
+
+def api_call(url, query, session, get_rna, get_dna, name=None, progress=None,
+        prefix=''):
+    global quiet 
+
+    json_data = get_summary(url, query, session, get_rna, get_dna)
+    if json_data is None:
+        return None
 
     for analysis_set in json_data:
-        if get_rna:
-            data_link = make_bam_datalink('RNA', analysis_set, s, header)
-            if not data_link:
-                return None
-        elif get_dna:
-            data_link = make_bam_datalink('DNA', analysis_set, s, header)
-            if not data_link:
-                return None
-        else:
-            data_link = analysis_set['data_links']
-
-        zip_name = name + '_download.zip'
-        with open(zip_name, 'wb') as zip_fh:
-            response = s.get(data_link, headers=header, verify=False, 
-                stream=True)
-            
-            total_size = response.headers.get('content-length', None)
-            if quiet is False:
-                prog_bar2(response, total_size, zip_fh)
-    if quiet is False:
+        data_link = get_data_link(analysis_set, session, get_rna, get_dna)
+        if not data_link:
+            return None
+        if not fetch_data(session, data_link, prefix + name + '_download.zip', 
+                get_rna or get_dna, progress):
+            return None
+
+    if quiet is False and progress is None:
         sys.stderr.write('Done!\n\n')
+    return True
+
+def fetch_data(session, data_link, zip_name, is_bam, progress=None):
+    """
+    Download data_link to zip_name, by way of the download store, segmented 
+    download, or a single (resumable) stream as needed.  Returns True once we
+    have the file, and raises IncompleteDownload if the server stopped short.
+    """
+    if extract and not is_bam:
+        return fetch_extract(session, data_link, zip_name, progress)
+
+    part_name = zip_name + '.part'
+    validator_file = zip_name + '.validator'
+
+    validators = None
+    if download_store is not None:
+        validators = download_store.check(session, data_link, zip_name)
+        if validators is None:
+            if quiet is False and progress is None:
+                sys.stdout.write('Unchanged since last download; using local '
+                    'copy of {}.\n'.format(zip_name))
+            return True
+
+    if is_bam and segments > 1:
+        status = segmented_download(session, data_link, zip_name, progress)
+        if status is True:
+            if os.path.isfile(validator_file):
+                os.remove(validator_file)
+            if download_store is not None:
+                download_store.add(data_link, zip_name, validators)
+            return True
+        # Otherwise the server can't give us byte ranges for this file, so
+        # fall through and get it on one stream.
+
+    state_file = zip_name + '.segments'
+    if os.path.isfile(state_file):
+        # A segmented download left this partial file preallocated to the
+        # full size, so its size says nothing about what we have; it can't be
+        # resumed on one stream.
+        for leftover in (part_name, state_file, validator_file):
+            if os.path.isfile(leftover):
+                os.remove(leftover)
+
+    response, offset = open_download(session, data_link, part_name, 
+        validator_file)
+    if response is None:
+        # The partial file from a previous run was already complete.
+        os.replace(part_name, zip_name)
+        if os.path.isfile(validator_file):
+            os.remove(validator_file)
+        if download_store is not None:
+            download_store.add(data_link, zip_name, validators)
+        return True
+
+    with response, open(part_name, 'ab' if offset else 'wb') as zip_fh:
+        total_size = response.headers.get('content-length', None)
+        if total_size is not None:
+            total_size = int(total_size) + offset
+        observer = progress
+        if observer is None:
+            observer = file_observer(total_size, offset)
+        try:
+            stream_to_file(response, zip_fh, observer)
+        finally:
+            if progress is None:
+                observer.finish()
+
+    wrote = os.path.getsize(part_name)
+    if total_size is not None and wrote != total_size:
+        raise IncompleteDownload('Incomplete download for {} ({} of {} '
+            'bytes). Run again to resume the download.'.format(zip_name, wrote, 
+            total_size))
+    os.replace(part_name, zip_name)
+    if os.path.isfile(validator_file):
+        os.remove(validator_file)
+    if download_store is not None:
+        download_store.add(data_link, zip_name, validators)
+    return True
+
+def fetch_extract(session, data_link, zip_name, progress=None):
+    """
+    Download data_link and unpack it straight into the sample directories and
+    the vcfs directory, rather than writing zip_name out and extracting it 
+    again later.  zipfile needs the central directory at the end of the 
+    archive before it can read anything, so the download is spooled in memory 
+    (or to a temp file once it gets big) until it's all here.  Returns True 
+    once it's unpacked, and raises IncompleteDownload if the server stopped 
+    short.
+    """
+    with session.get(data_link, stream=True) as response, \
+            tempfile.SpooledTemporaryFile(ir_extract.spool_size, 
+                dir='.') as tmp:
+        response.raise_for_status()
+        total_size = response.headers.get('content-length', None)
+        if total_size is not None:
+            total_size = int(total_size)
+        observer = progress
+        if observer is None:
+            observer = file_observer(total_size)
+        try:
+            stream_to_file(response, tmp, observer)
+        finally:
+            if progress is None:
+                observer.finish()
+
+        wrote = tmp.tell()
+        if total_size is not None and wrote != total_size:
+            raise IncompleteDownload('Incomplete download for {} ({} of {} '
+                'bytes).'.format(zip_name, wrote, total_size))
+        tmp.seek(0)
+        try:
+            samples = ir_extract.extract_download(tmp, '.', 'vcfs', 
+                *extract_patterns, bgzip=extract_bgzip)
+        except (zipfile.BadZipFile, ValueError) as error:
+            cprint('\n\tCould not extract {}: {}\n'.format(zip_name, error), 
+                'red', attrs=['bold'], file=sys.stderr)
+            return False
+
+    if quiet is False and progress is None:
+        sys.stdout.write('Extracted {} sample(s) ({} VCF) from {}.\n'.format(
+            len(samples), sum(len(v) for n, v in samples), zip_name))
+    return True
+
+def get_validator(response):
+    """
+    Return what to send back in an If-Range header to make sure we're resuming
+    the same file; a strong ETag if we have one, or else the Last-Modified 
+    date.  None if the server gave us neither.
+    """
+    etag = response.headers.get('etag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return response.headers.get('last-modified')
+
+def open_download(session, data_link, part_file, validator_file):
+    """
+    Start streaming data_link, resuming from the end of part_file if we have a
+    partial download from an earlier attempt.  If the server honours the Range
+    request we'll get a 206 back and can append to the file.  If not (a 200 
+    with the whole file, or a Content-Range that doesn't start where we left 
+    off), start again from the beginning.  Returns the response and the offset
+    at which the response body starts, or (None, size) if the partial file 
+    turns out to already be complete.
+
+    The ETag or Last-Modified date of a new download is kept in 
+    validator_file, and sent back in an If-Range header when resuming, so 
+    that if the file has changed on the server (e.g. the analysis was run 
+    again) we get the whole new file back rather than the end of it tacked on
+    to the old one.
+    """
+    offset = 0
+    if os.path.isfile(part_file):
+        offset = os.path.getsize(part_file)
+
+    if offset:
+        headers = {'Range' : 'bytes={}-'.format(offset)}
+        if os.path.isfile(validator_file):
+            with open(validator_file) as fh:
+                headers['If-Range'] = fh.read().strip()
+        response = session.get(data_link, stream=True, headers=headers)
+        content_range = response.headers.get('content-range', '')
+
+        if response.status_code == 416 and content_range == 'bytes */{}'.format(
+                offset):
+            response.close()
+            return None, offset
+        elif (response.status_code == 206 
+                and content_range.startswith('bytes {}-'.format(offset))):
+            return response, offset
+
+        # Server can't resume this one. If it at least handed us the whole 
+        # file, use it rather than making another request.
+        if response.status_code != 200:
+            response.close()
+            response = session.get(data_link, stream=True)
+    else:
+        response = session.get(data_link, stream=True)
+
+    try:
+        response.raise_for_status()
+    except requests.exceptions.HTTPError:
+        # Give up the connection (and the host slot) before passing it on.
+        response.close()
+        raise
 
-def prog_bar2(response, size, fh):
+    validator = get_validator(response)
+    if validator is not None:
+        with open(validator_file, 'w') as fh:
+            fh.write(validator + '\n')
+    elif os.path.isfile(validator_file):
+        os.remove(validator_file)
+    return response, 0
+
+def get_remote_size(session, data_link):
+    """
+    Ask for the first byte of the file to find out if the server will give us
+    byte ranges, and if so, how big the whole file is. Returns None if either 
+    is not the case.
+    """
+    return get_remote_info(session, data_link)[0]
+
+def get_remote_info(session, data_link):
+    """
+    Same as get_remote_size(), but returns the size along with the validator
+    (see get_validator()) for the file, or (None, None).
+    """
+    with session.get(data_link, stream=True, 
+            headers={'Range' : 'bytes=0-0'}) as response:
+        if response.status_code != 206:
+            return None, None
+        match = re.match(r'bytes 0-0/(\d+)$', 
+            response.headers.get('content-range', ''))
+        validator = get_validator(response)
+    if match is None:
+        return None, None
+    return int(match.group(1)), validator
+
+def segmented_download(session, data_link, outfile, progress=None):
+    """
+    Download a large BAM file as a number of byte ranges at the same time, 
+    each on its own connection, written with positioned writes into a file 
+    preallocated to the full size. Progress for each segment is kept in a 
+    '.segments' file if we don't finish, so that a re-run only asks for the 
+    missing ranges.  The file's validator is kept there too, and sent with 
+    each range request in an If-Range header, so that if the file changes on 
+    the server in the meantime we start it over rather than mixing the two.
+    
+    Returns True if the download completed, and None if the server didn't 
+    give us a size or range support, in which case we need to fall back to a 
+    single stream. Raises IncompleteDownload if any of the segments failed.
+    """
+    size, validator = get_remote_info(session, data_link)
+    if not size:
+        return None
+
+    part_file = outfile + '.part'
+    state_file = outfile + '.segments'
+    ranges = None
+    if os.path.isfile(state_file) and os.path.isfile(part_file):
+        with open(state_file) as fh:
+            state = json.load(fh)
+        if (state['size'] == size and os.path.getsize(part_file) == size 
+                and state.get('validator') == validator):
+            ranges = state['ranges']
+    if ranges is None:
+        step = -(-size // segments)
+        ranges = [[start, min(start + step, size) - 1, 0] 
+            for start in range(0, size, step)]
+        with open(part_file, 'wb') as fh:
+            fh.truncate(size)
+
+    lock = threading.Lock()
+    changed = []
+    observer = progress
+    if observer is None:
+        observer = file_observer(size, sum(r[2] for r in ranges))
+
+    def fetch_range(segment):
+        start, end, done = segment
+        if start + done > end:
+            return
+        headers = {'Range' : 'bytes={}-{}'.format(start + done, end)}
+        if validator is not None:
+            headers['If-Range'] = validator
+        with session.get(data_link, stream=True, headers=headers) as response:
+            if response.status_code == 200 and validator is not None:
+                # The whole file instead of our range; it's changed since we
+                # started.
+                changed.append(True)
+            if response.status_code != 206:
+                raise requests.exceptions.HTTPError('Server did not return '
+                    'the byte range {}-{} (status {}).'.format(start + done, 
+                    end, response.status_code), response=response)
+            for buf in iter_chunks(response):
+                os.pwrite(fd, buf, start + segment[2])
+                with lock:
+                    segment[2] += len(buf)
+                observer.add_bytes(len(buf))
+
+    fd = os.open(part_file, os.O_WRONLY)
+    error = None
+    try:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            for future in as_completed([executor.submit(fetch_range, r) 
+                    for r in ranges]):
+                if future.exception() is not None and error is None:
+                    error = future.exception()
+    finally:
+        os.close(fd)
+        if progress is None:
+            observer.finish()
+        complete = all(r[2] == r[1] - r[0] + 1 for r in ranges)
+        if changed:
+            for leftover in (part_file, state_file):
+                if os.path.isfile(leftover):
+                    os.remove(leftover)
+        elif not complete:
+            with open(state_file, 'w') as fh:
+                json.dump({'size' : size, 'validator' : validator, 
+                    'ranges' : ranges}, fh)
+
+    if changed:
+        raise IncompleteDownload('{} changed on the server during the '
+            'download; starting it over.'.format(outfile))
+
+    if not complete or os.path.getsize(part_file) != size:
+        raise IncompleteDownload('Incomplete segmented download for {} ({}). '
+            'Run again to resume the download.'.format(outfile, error))
+
+    os.replace(part_file, outfile)
+    if os.path.isfile(state_file):
+        os.remove(state_file)
+    return True
+
+def iter_chunks(response):
+    """
+    Yield the body of a streamed response in chunk_size pieces. In zero copy 
+    mode, we read the raw socket data straight into one buffer that gets 
+    reused for every chunk, rather than having a new bytes object made for 
+    each one.  The chunks are then memoryview slices of that buffer, so 
+    whoever is consuming them has to be done with each one (i.e. have written 
+    it out) before asking for the next.
+
+    Zero copy reads bypass the urllib3 decoding layer, so we only use them 
+    when the body is not content-encoded.  Note too that urllib3 can't hand
+    the connection back to the pool after this kind of read, which is fine for
+    the big BAM files this is meant for.
+    """
+    raw = getattr(response.raw, '_fp', None)
+    encoding = response.headers.get('content-encoding', 'identity')
+    if not zero_copy or raw is None or encoding != 'identity':
+        for buf in response.iter_content(chunk_size):
+            if buf:
+                yield buf
+        return
+
+    view = memoryview(bytearray(chunk_size))
+    while True:
+        size = raw.readinto(view)
+        if not size:
+            break
+        yield view[:size]
+
+def stream_to_file(response, fh, observer):
+    """
+    Write the response body out to the filehandle. This always runs, whether
+    or not we're drawing anything; the observer is only told how many bytes 
+    were written so that it can report progress (or not) as it sees fit.
+    """
+    for buf in iter_chunks(response):
+        fh.write(buf)
+        observer.add_bytes(len(buf))
+
+def file_observer(size, offset=0):
+    """
+    Return the progress observer to use for a single file download; a progress
+    bar normally, or one that does nothing at all if we're running quietly.
+    """
+    if quiet is True:
+        return NullProgress()
+    return FileProgress(size, offset)
+
+class NullProgress(object):
+    """
+    Progress observer for quiet mode. Skips all terminal output.
+    """
+    def add_bytes(self, size):
+        pass
+
+    def finish(self):
+        pass
+
+class FileProgress(object):
     """
     Using the ProgressBar2 library, generate a progress bar to help determine
     the download speed, time, etc.  Not very useful for VCF files as they come
     down almost instantly.  But, for BAM files, helpful to get an idea of how 
     long it'll take to get here.  For DNA BAM files, we don't know the size, so
     just output the amount downloaded, speed, etc.  For RNA BAM, can get a whole
-    set of data.
+    set of data.  If we're resuming a download, the bar starts at the offset
+    already on disk.  The bar is only redrawn every progress_interval seconds 
+    rather than for every chunk, and can be fed from more than one thread for 
+    segmented downloads.
     """
-    wrote = 0
+    def __init__(self, size, offset=0):
+        self.wrote = offset
+        self.lock = threading.Lock()
+        self.pbar = file_pbar(size)
+        self.pbar.update(self.wrote)
+        self.last_update = time.monotonic()
+
+    def add_bytes(self, size):
+        with self.lock:
+            self.wrote += size
+            if time.monotonic() - self.last_update > progress_interval:
+                self.pbar.update(self.wrote)
+                self.last_update = time.monotonic()
 
+    def finish(self):
+        self.pbar.update(self.wrote)
+        self.pbar.finish()
+
+def file_pbar(size):
+    """
+    Start a ProgressBar2 bar for a single file.  If we don't know the size, 
+    just output the amount downloaded, speed, etc.
+    """
     if size is None:
         # Have a DNA BAM and don't know the actual size.
         widgets = [
@@ -325,13 +1653,312 @@ def prog_bar2(response, size, fh):
         size = int(size)
         pbar = progressbar.ProgressBar(widgets=widgets, maxval=size,
                 term_width=80).start()
+    return pbar
+
+class BatchProgress(object):
+    """
+    Combined progress display for a batch of analyses being retrieved at the 
+    same time.  Worker threads report the bytes they've written, and a status 
+    line for each analysis ID as it finishes, and we keep a single bar with the
+    overall count, amount downloaded, and speed.
+    """
+    def __init__(self, total, label='analyses'):
+        self.total = total
+        self.done = 0
+        self.wrote = 0
+        self.lock = threading.Lock()
+        self.pbar = None
+        self.last_update = 0
+
+        if quiet is False:
+            self.counter = progressbar.FormatCustomText(
+                '[%(done)d/%(total)d] ' + label + '; ', 
+                dict(done=0, total=total)
+            )
+            widgets = [
+                self.counter,
+                'Downloaded: ',
+                progressbar.DataSize(),
+                ' (',
+                progressbar.FileTransferSpeed(), ' | ', progressbar.Timer(), ')',
+            ]
+            self.pbar = progressbar.ProgressBar(
+                widgets=widgets, 
+                max_value=progressbar.UnknownLength,
+                redirect_stdout=True
+            ).start()
+
+    def add_bytes(self, size):
+        with self.lock:
+            self.wrote += size
+            if (self.pbar is not None 
+                    and time.monotonic() - self.last_update > progress_interval):
+                self.pbar.update(self.wrote)
+                self.last_update = time.monotonic()
+
+    def add_key(self):
+        with self.lock:
+            self.total += 1
+            if self.pbar is not None:
+                self.counter.update_mapping(total=self.total)
+
+    def report(self, key, status):
+        with self.lock:
+            self.done += 1
+            if self.pbar is not None:
+                self.counter.update_mapping(done=self.done)
+                sys.stdout.write('  {:<8} {}\n'.format(
+                    'OK' if status else 'FAILED', key))
+                self.pbar.update(self.wrote)
 
-    for buf in response.iter_content(1024):
-        if buf:
-            fh.write(buf)
-            wrote += len(buf)
-            pbar.update(wrote)
-    pbar.finish()
+    def finish(self):
+        if self.pbar is not None:
+            self.pbar.update(self.wrote)
+            self.pbar.finish()
+
+def single_query(expt):
+    return {
+        'format'  : 'json', 
+        'name'    : expt, 
+        'exclude' : 'filteredvariants'
+    }
+
+def retrieve_analysis(url, session, expt, get_rna, get_dna, progress=None,
+        prefix=''):
+    """
+    Retrieve the data for a single analysis ID.  Returns True if the data was
+    downloaded, and False otherwise so that we can report on the batch.  The
+    prefix goes on the front of the file name (i.e. the host name when we're
+    getting data from more than one, since they can have the same IDs).
+    """
+    try:
+        return bool(with_retries(session, expt, api_call, url, 
+            single_query(expt), session, get_rna, get_dna, expt, progress, 
+            prefix))
+    except (requests.exceptions.RequestException, zipfile.BadZipFile, KeyError,
+            OSError) as error:
+        # A bad .rrs archive or a missing member in it only fails this one.
+        cprint('\n\t{}\n\tSkipping analysis id: {}.\n'.format(error, expt), 
+            'red', attrs=['bold'], file=sys.stderr)
+        return False
+
+def resolve_analysis(url, session, expt, get_rna, get_dna, host='', 
+        prefix=''):
+    """
+    Resolve the data link(s) and size(s) for an analysis ID without 
+    downloading anything, for the manifest.  Returns a list of manifest 
+    entries, or None if the analysis couldn't be resolved.  The prefix goes on
+    the front of the output file name, as with retrieve_analysis().
+    """
+    if get_rna:
+        datatype = 'RNA'
+    elif get_dna:
+        datatype = 'DNA'
+    else:
+        datatype = 'VCF'
+
+    def resolve():
+        json_data = get_summary(url, single_query(expt), session, get_rna, 
+            get_dna)
+        if json_data is None:
+            return None
+
+        entries = []
+        for analysis_set in json_data:
+            data_link = get_data_link(analysis_set, session, get_rna, get_dna)
+            if not data_link:
+                return None
+            entries.append({
+                'name'      : expt,
+                'type'      : datatype,
+                'size'      : get_remote_size(session, data_link),
+                'outfile'   : prefix + expt + '_download.zip',
+                'data_link' : data_link,
+                'host'      : host,
+            })
+        return entries
+
+    try:
+        return with_retries(session, expt, resolve)
+    except (requests.exceptions.RequestException, zipfile.BadZipFile, KeyError,
+            OSError) as error:
+        cprint('\n\t{}\n\tUnable to resolve analysis id: {}.\n'.format(error, 
+            expt), 'red', attrs=['bold'], file=sys.stderr)
+        return None
+
+def fetch_entry(session, entry, progress=None):
+    """
+    Download one entry from a manifest. Returns True if we got the file.
+    """
+    try:
+        return with_retries(session, entry['outfile'], fetch_data, session, 
+            entry['data_link'], entry['outfile'], entry['type'] != 'VCF', 
+            progress)
+    except requests.exceptions.RequestException as error:
+        cprint('\n\t{}\n\tSkipping {}.\n'.format(error, entry['outfile']), 
+            'red', attrs=['bold'], file=sys.stderr)
+        return False
+
+def write_manifest(manifest, entries):
+    """
+    Write the resolved entries out as a TSV if the manifest file name ends 
+    with '.tsv', and as JSON otherwise.
+    """
+    with open(manifest, 'w') as fh:
+        if manifest.endswith('.tsv'):
+            writer = csv.DictWriter(fh, fieldnames=manifest_fields, 
+                delimiter='\t', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(entries)
+        else:
+            json.dump(entries, fh, indent=4)
+
+def read_manifest(manifest):
+    try:
+        with open(manifest) as fh:
+            if manifest.endswith('.tsv'):
+                entries = list(csv.DictReader(fh, delimiter='\t'))
+            else:
+                entries = json.load(fh)
+    except (IOError, ValueError) as error:
+        sys.stderr.write("ERROR: Unable to read manifest '{}': {}\n".format(
+            manifest, error))
+        sys.exit(1)
+
+    for entry in entries:
+        # Manifests from before we had multiple hosts won't have one.
+        entry.setdefault('host', '')
+        missing = [f for f in manifest_fields if f not in entry]
+        if missing:
+            sys.stderr.write("ERROR: Manifest entry {} is missing the field(s):"
+                " {}\n".format(entry, ', '.join(missing)))
+            sys.exit(1)
+        entry['size'] = int(entry['size']) if entry['size'] else None
+    return entries
+
+def write_failed(results, failed_file, entries=None):
+    """
+    Write out whatever failed permanently so that it can be run again; as a 
+    batch file of analysis IDs, or as a manifest if we were given the 
+    manifest entries.
+    """
+    failed = [key for key in results if not results[key]]
+    if not failed:
+        return
+    if entries is not None:
+        write_manifest(failed_file, [entries[key] for key in failed])
+    else:
+        with open(failed_file, 'w') as fh:
+            fh.write('\n'.join(failed) + '\n')
+    sys.stderr.write('Wrote the {} failed item(s) to {} to run again.\n'.format(
+        len(failed), failed_file))
+
+def human_size(size):
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TiB'.format(size)
+
+def run_batch(worker, keys, jobs, label='analyses', progress=None, prefix=''):
+    """
+    Run worker(key, progress) for each key using a pool of worker threads, 
+    with one combined progress display for the whole batch. The keys can come
+    from a generator that is still listing them while the first ones are being
+    worked on; the total in the progress display grows as they come in. 
+    Returns a dict of key to whatever the worker returned for it, in the order
+    the keys were given.
+
+    A progress display can be passed in to share it between batches run at 
+    the same time (e.g. one per host), in which case the caller finishes it,
+    and the prefix is added to the keys in the status lines.
+    """
+    results = {}
+    shared = progress is not None
+    if not shared:
+        progress = BatchProgress(0, label)
+
+    def finished(key, future):
+        try:
+            results[key] = future.result()
+        except Exception as error:
+            cprint('\n\t{}\n\tFailed on {}{}.\n'.format(error, prefix, key), 
+                'red', attrs=['bold'], file=sys.stderr)
+            results[key] = False
+        progress.report(prefix + key, results[key])
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for key in keys:
+            results[key] = None
+            progress.add_key()
+            future = executor.submit(worker, key, progress)
+            future.add_done_callback(functools.partial(finished, key))
+    if not shared:
+        progress.finish()
+    return results
+
+def run_hosts(targets, make_worker, jobs, label='analyses'):
+    """
+    Run a batch for each of the hosts in targets, a list of (name, url, 
+    session, keys), all at the same time.  Each host gets its own pool of jobs
+    workers (and its own session, so its own connection pool and limits), and
+    they share one progress display.  make_worker(name, url, session) returns 
+    the worker for a host.  Returns a dict of host name to batch results.
+    """
+    progress = BatchProgress(0, label)
+    prefix = len(targets) > 1
+    with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+        futures = {
+            name : executor.submit(run_batch, make_worker(name, url, session), 
+                keys, jobs, label, progress, name + ':' if prefix else '')
+            for name, url, session, keys in targets
+        }
+    progress.finish()
+    return {name : futures[name].result() for name in futures}
+
+def print_summary(results, label='analyses', key_type='analysis IDs'):
+    failed = [key for key in results if not results[key]]
+    if quiet is False:
+        sys.stdout.write('\nRetrieved {} of {} {}.\n'.format(
+            len(results) - len(failed), len(results), label))
+    if failed:
+        cprint('Failed to retrieve the following {}:'.format(key_type), 'red', 
+            attrs=['bold'], file=sys.stderr)
+        for key in failed:
+            sys.stderr.write('\t{}\n'.format(key))
+    sys.stdout.flush()
+
+def report_hosts(results, failed_file=None):
+    """
+    Print the summary for a dict of host name to batch results, and write out
+    the failed analysis IDs to a batch file; one per host if we have more than
+    one, since the IDs need to be run again against the right host.
+    """
+    if len(results) == 1:
+        host_results = list(results.values())[0]
+        print_summary(host_results)
+        write_failed(host_results, failed_file or 'failed_analyses.txt')
+        return
+
+    print_summary({'{}:{}'.format(name, expt) : results[name][expt] 
+        for name in results for expt in results[name]})
+    base, ext = os.path.splitext(failed_file or 'failed_analyses.txt')
+    for name in results:
+        write_failed(results[name], '{}.{}{}'.format(base, name, ext))
+
+def report_listing(listing_failed):
+    """
+    List the date windows we couldn't get the results for, for each host, 
+    since none of their analyses made it into the batch (or the failed file).
+    """
+    for name in listing_failed:
+        if not listing_failed[name]:
+            continue
+        cprint('Could not list the results from IR {} for the following dates;'
+            ' run them again with "--date-range":'.format(name), 'red', 
+            attrs=['bold'], file=sys.stderr)
+        for win_start, win_end in listing_failed[name]:
+            sys.stderr.write('\t{},{}\n'.format(win_start, win_end))
 
 def main():
     cli_args = get_args()
@@ -342,86 +1969,228 @@ def main():
     else:
         datatype = 'VCF data'
     
-    global quiet
+    global quiet, segments, chunk_size, zero_copy, summary_cache, \
+        download_store, extract, extract_patterns, extract_bgzip
     quiet = cli_args.quiet
+    segments = cli_args.segments
+    chunk_size = max(int(cli_args.chunk_size * 1024 * 1024), 1)
+    zero_copy = cli_args.zero_copy
+    if cli_args.cache_ttl > 0:
+        # Everything a sync gets is new or has changed since it was listed, so
+        # a cached summary (and data link) for it would be out of date; get 
+        # them fresh, but still keep them in the cache.
+        summary_cache = SummaryCache(cli_args.cache_dir, 
+            cli_args.cache_ttl * 3600, cli_args.cache_max_size * 1024 * 1024, 
+            cli_args.refresh or cli_args.sync)
+    if cli_args.store:
+        download_store = DownloadStore(cli_args.store)
+    if cli_args.extract:
+        extract = True
+        extract_bgzip = cli_args.bgzip
+        if cli_args.vcf_only:
+            extract_patterns = (ir_extract.vcf_include, ir_extract.vcf_exclude)
+        os.makedirs('vcfs', exist_ok=True)
     if quiet is True:
         sys.stdout.write("Running in silent mode.\n")
         sys.stdout.flush()
 
-    server = cli_args.Host if cli_args.Host else cli_args.ip
-
-    if cli_args.ip and cli_args.token:
-        server_url = format_url(cli_args.ip) 
-        api_token = cli_args.token
-    else:
-        program_config = Config.read_config(config_file)
-        server_url, api_token = get_host(cli_args.Host, program_config['hosts'])
-
-    server_url += '/api/v1/'
+    hosts = get_hosts(cli_args)
 
     analysis_ids=[]
     if cli_args.batch:
         analysis_ids = proc_batchfile(cli_args.batch)
     elif cli_args.analysis_id:
         analysis_ids.append(cli_args.analysis_id)
-    elif not cli_args.date_range:
+    elif not cli_args.date_range and not cli_args.fetch and not cli_args.sync:
         sys.stderr.write("ERROR: No analysis ID or batch file loaded!\n")
         sys.exit(1)
 
-    header = {
-        'Authorization' : api_token,
-        'Content-Type'  : 'application/x-www-form-urlencoded',
-    }
-    method=cli_args.method
-    url = server_url + method
-    #  print('::DEBUG:: formated base url: {}'.format(url))
-    #  sys.exit()
+    if len(hosts) > 1 and not (cli_args.date_range or cli_args.fetch or 
+            cli_args.sync):
+        sys.stderr.write("ERROR: Multiple hosts can only be used with "
+            "'--date-range', '--sync', or '--fetch', since we don't know which "
+            "host an analysis ID is on.\n")
+        sys.exit(1)
+
+    sync_state = None
+    listing_failed = {name : [] for name, server_url, api_token in hosts}
+    if cli_args.sync:
+        sync_state = SyncState(cli_args.sync_db)
+        today = datetime.date.today()
+        sync_from = {}
+        for name, server_url, api_token in hosts:
+            # Start from the last day we listed rather than the day after, since
+            # more analyses may have finished on that day after we listed it.
+            sync_from[name] = sync_state.listed_to(name)
+            if sync_from[name] is None:
+                if not cli_args.date_range:
+                    sys.stderr.write("ERROR: Host {} has not been synced "
+                        "before. Use '--date-range' to say where to start "
+                        "from.\n".format(name))
+                    sys.exit(1)
+                sync_from[name] = __validate_date(
+                    cli_args.date_range.split(',')[0])
+
+    pool_size = cli_args.pool_size if cli_args.pool_size else max(10, 
+        cli_args.jobs * segments)
+    policy = RetryPolicy(cli_args.retries, cli_args.max_delay)
+    sessions = {}
+    for name, server_url, api_token in hosts:
+        header = {
+            'Authorization' : api_token,
+            'Content-Type'  : 'application/x-www-form-urlencoded',
+        }
+        sessions[name] = make_session(header, pool_size, policy, 
+            cli_args.host_limit)
+
+    if cli_args.fetch:
+        manifest_entries = read_manifest(cli_args.fetch)
+        outfiles = collections.Counter(e['outfile'] for e in manifest_entries)
+        entries = {}
+        for entry in manifest_entries:
+            if outfiles[entry['outfile']] > 1 and entry['host']:
+                # Same file name from more than one host; keep them apart.
+                entry['outfile'] = entry['host'] + '_' + entry['outfile']
+            entries['{}:{}'.format(entry['host'], entry['outfile'])] = entry
+        if quiet is False:
+            sys.stdout.write('Fetching {} files ({}) from manifest {}.\n\n'.format(
+                len(entries), 
+                human_size(sum(e['size'] or 0 for e in entries.values())), 
+                cli_args.fetch))
+            sys.stdout.flush()
+
+        def fetch(key, progress):
+            entry = entries[key]
+            session = sessions.get(entry['host'] or hosts[0][0])
+            if session is None:
+                cprint('\n\tNo session for host {} to fetch {}. Include it '
+                    'with the "-H" option.\n'.format(entry['host'], 
+                    entry['outfile']), 
+                    'red', attrs=['bold'], file=sys.stderr)
+                return False
+            return fetch_entry(session, entry, progress)
+
+        results = run_batch(fetch, list(entries), cli_args.jobs, 'files')
+        print_summary(results, 'files', 'files')
+        base, ext = os.path.splitext(cli_args.fetch)
+        write_failed(results, cli_args.failed_file or base + '.failed' + ext,
+            entries)
+        return
 
-    if cli_args.date_range:
+    if cli_args.date_range and not cli_args.sync:
         # Allow for one to just put one date to look for data on that date alone
         start, end = (cli_args.date_range.split(',') + [None]*2)[:2]
         if end is None:
             end = start
-        __validate_date(start)
-        __validate_date(end)
+        start = __validate_date(start)
+        end = __validate_date(end)
+
+    method=cli_args.method
+    targets = []
+    for name, server_url, api_token in hosts:
+        url = server_url + method
+        if cli_args.sync:
+            if quiet is False:
+                sys.stdout.write('Syncing IR {}; listing results for dates from '
+                    '{} to {}, {} day(s) at a time.\n'.format(name, 
+                    sync_from[name], today, cli_args.window_days))
+                sys.stdout.flush()
+            host_ids = sync_state.sync_ids(name, list_range(url, sessions[name],
+                sync_from[name], today, cli_args.window_days, cli_args.rna, 
+                cli_args.dna, True, listing_failed[name]), extract)
+        elif cli_args.date_range:
+            if quiet is False:
+                sys.stdout.write('Listing results from IR {} for dates from {} '
+                    'to {}, {} day(s) at a time.\n'.format(name, start, end, 
+                    cli_args.window_days))
+                sys.stdout.flush()
+            host_ids = list_range(url, sessions[name], start, end, 
+                cli_args.window_days, cli_args.rna, cli_args.dna, False, 
+                listing_failed[name])
+        else:
+            host_ids = analysis_ids
+        targets.append((name, url, sessions[name], host_ids))
+
+    server = ', '.join(name for name, url, session, keys in targets)
+    if analysis_ids and not cli_args.date_range:
+        total = len(analysis_ids)
+    else:
+        total = '?'
+
+    # The same analysis ID can be on more than one host, so name the files 
+    # for the host too when there's more than one.
+    prefix = len(targets) > 1
 
+    if cli_args.resolve:
         if quiet is False:
-            sys.stdout.write('Getting list of results from IR {} for dates from {} '
-                'to {}...'.format(server, start, end))
+            sys.stdout.write('Resolving {} links from IR {} (total runs: '
+                '{}).\n\n'.format(datatype, server, total))
             sys.stdout.flush()
-        query = {
-            'format' : 'json', 
-            'start_date' : start, 
-            'end_date' : end, 
-            'exclude' : 'filteredvariants' 
-        }
+        resolved = run_hosts(targets, 
+            lambda name, url, session: lambda expt, progress: resolve_analysis(
+                url, session, expt, cli_args.rna, cli_args.dna, name, 
+                name + '_' if prefix else ''),
+            cli_args.jobs
+        )
+        entries = [e for name in resolved for expt in resolved[name] 
+            if resolved[name][expt] for e in resolved[name][expt]]
+        write_manifest(cli_args.resolve, entries)
+        if quiet is False:
+            sizes = [e['size'] for e in entries if e['size'] is not None]
+            sys.stdout.write('\nWrote {} files ({}, {} of unknown size) to '
+                'manifest {}.\n'.format(len(entries), human_size(sum(sizes)), 
+                len(entries) - len(sizes), cli_args.resolve))
+        report_hosts(resolved, cli_args.failed_file)
+        report_listing(listing_failed)
+        return
 
-        analysis_ids = api_call(url, query, header, 'range', cli_args.rna, 
-            cli_args.dna)
-    
     if quiet is False:
         sys.stdout.write('Getting data from IR {} (total runs: {}).\n\n'.format(
-            server, len(analysis_ids)))
+            server, total))
         sys.stdout.flush()
-    count = 0
+    def retriever(name, url, session):
+        def retrieve(expt, progress=None):
+            result = retrieve_analysis(url, session, expt, cli_args.rna, 
+                cli_args.dna, progress, name + '_' if prefix else '')
+            if result and sync_state is not None:
+                sync_state.done(name, expt, extract)
+            return result
+        return retrieve
 
-    for expt in analysis_ids:
-        count += 1
-        if quiet is False:
-            sys.stdout.write('[{}/{}]  Retrieving {} for analysis ID: {}...\n'.format(
-                count, len(analysis_ids), datatype, expt)
-            )
-            sys.stdout.flush()
-        query = {
-            'format'  : 'json', 
-            'name'    : expt, 
-            'exclude' : 'filteredvariants'
-        }
-        api_call(url, query, header, 'single', cli_args.rna, cli_args.dna, expt)
+    if cli_args.jobs > 1 or len(targets) > 1:
+        results = run_hosts(targets, retriever, cli_args.jobs)
+    else:
+        name, url, session, host_ids = targets[0]
+        retrieve = retriever(name, url, session)
+        results = {name : {}}
+        count = 0
 
-        if quiet is True:
-            sys.stdout.write("Finished downloading IR data.\n")
-            sys.stdout.flush()
+        for expt in host_ids:
+            count += 1
+            if quiet is False:
+                sys.stdout.write('[{}/{}]  Retrieving {} for analysis ID: '
+                    '{}...\n'.format(count, total, datatype, expt)
+                )
+                sys.stdout.flush()
+            results[name][expt] = retrieve(expt)
+
+    if sync_state is not None:
+        # Only move the listing on if we got through all of it; anything that
+        # failed to download is still pending for the next run either way.
+        for name in results:
+            if listing_failed[name]:
+                cprint('\tCould not list all of the results from IR {}; the '
+                    'next sync will list from {} again.'.format(name, 
+                    sync_from[name]), 'yellow', file=sys.stderr)
+            else:
+                sync_state.set_listed_to(name, today)
+
+    if quiet is True:
+        sys.stdout.write("Finished downloading IR data.\n")
+        sys.stdout.flush()
+    report_hosts(results, cli_args.failed_file)
+    if sync_state is None:
+        report_listing(listing_failed)
 
 if __name__ == '__main__':
     try:
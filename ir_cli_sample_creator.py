@@ -1,10 +1,5 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
-# TODO:
-#    - Need to add a function to import data from a flat file.  If the DNA and 
-#      RNA names are not the same, it's tough to figure out how to pair them
-#      correctly.  So we have to gen the files and then manually edit them! 
-#
 # 12/9/2015 - D Sims
 ################################################################################
 """
@@ -23,6 +18,16 @@ We can also use this script to upload VCF files for annotation workflow only. In
 this case the naming requirements are far fewer, and no DNA / RNA string is 
 required.  
 
+If the names don't fit, or each sample needs its own cellularity, gender, or 
+tumor type, use a CSV / TSV manifest ('--manifest') instead, with a header row 
+and the columns:
+
+            sample, path, type, cellularity, gender, cancerType
+
+where 'sample' is the key that DNA and RNA files are paired up on, 'type' is 
+DNA, RNA, or VCF, and the last three are optional (the command line values are 
+used if they're left blank).
+
 """
 import sys
 import os
@@ -31,11 +36,21 @@ import argparse
 import time
 import json
 import random
+import fnmatch
+import itertools
+import struct
+import csv
+import heapq
+import shlex
+import subprocess
+import bgzf
 from collections import defaultdict
+from concurrent.futures import (ThreadPoolExecutor, wait, FIRST_COMPLETED, 
+    as_completed)
 from termcolor import cprint
 from pprint import pprint as pp  # noqa
 
-version = '4.2.051420'
+version = '4.7.101726'
 
 config_file = os.path.join(
     os.path.dirname(os.path.realpath(__file__)),
@@ -133,6 +148,124 @@ def get_args():
         metavar='<BAM | VCF files>', 
         help='BAM or VCF files to process.'
     )
+    parser.add_argument(
+        '--scan',
+        metavar='<dir>',
+        help='Scan this directory for the BAM (or VCF) files to process rather '
+            'than (or as well as) listing them on the command line.'
+    )
+    parser.add_argument(
+        '--recursive',
+        action='store_true',
+        help='With "--scan", look through all of the subdirectories too. They '
+            'are scanned in parallel.'
+    )
+    parser.add_argument(
+        '--include',
+        metavar='<glob>',
+        action='append',
+        help='With "--scan", only take files matching this pattern. Can be used '
+            'more than once. (DEFAULT: "*.bam", or "*.vcf" with "--VCF")'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<int>',
+        type=int,
+        default=8,
+        help='Number of directories to scan with "--scan --recursive", or BAM '
+            'headers to read with "--pair-by-header", at the same time. '
+            '(DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--manifest',
+        metavar='<csv | tsv file>',
+        help='CSV or TSV file of the samples to process, with columns for the '
+            'sample (pairing key), path, type (DNA, RNA, or VCF), and '
+            'optionally cellularity, gender, and cancerType for each one.'
+    )
+    parser.add_argument(
+        '--shard-size',
+        metavar='<int>',
+        type=int,
+        help='Split the samples up into numbered sample.list / sample.meta '
+            'pairs of at most this many samples each, balanced by the total '
+            'size of their files. A DNA / RNA pair is never split.'
+    )
+    parser.add_argument(
+        '--shards',
+        metavar='<int>',
+        type=int,
+        help='Split the samples up into this many numbered sample.list / '
+            'sample.meta pairs, balanced by the total size of their files.'
+    )
+    parser.add_argument(
+        '-o', '--outdir',
+        metavar='<dir>',
+        default='.',
+        help='Directory to write the sample.list and sample.meta files to. '
+            '(DEFAULT: current directory)'
+    )
+    parser.add_argument(
+        '--on-exists',
+        choices=('prompt', 'overwrite', 'rename', 'fail'),
+        default='prompt' if sys.stdin.isatty() else 'fail',
+        help='What to do if an output file already exists; ask (the default '
+            'when run from a terminal), overwrite it, write to the next free '
+            'numbered name instead, or stop without writing anything (the '
+            'default otherwise).'
+    )
+    parser.add_argument(
+        '--submit',
+        action='store_true',
+        help='Once the files are written, upload each sample.list / sample.meta '
+            'pair (i.e. each shard) with irucli, several at a time. The output '
+            'of each run goes to a .log file next to its sample.list.'
+    )
+    parser.add_argument(
+        '--irucli',
+        metavar='<path>',
+        default='irucli.sh',
+        help='irucli script to run with "--submit". (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--irucli-args',
+        metavar='<args>',
+        default='',
+        help='Any other arguments to pass to irucli (e.g. the server and '
+            'credentials), as one quoted string, e.g. --irucli-args="-u me".'
+    )
+    parser.add_argument(
+        '--submit-jobs',
+        metavar='<int>',
+        type=int,
+        default=2,
+        help='Number of irucli uploads to run at the same time with '
+            '"--submit". (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--submit-retries',
+        metavar='<int>',
+        type=int,
+        default=2,
+        help='Number of times to retry a failed upload. (DEFAULT: '
+            '%(default)s)'
+    )
+    parser.add_argument(
+        '--retry-delay',
+        metavar='<seconds>',
+        type=float,
+        default=30,
+        help='Seconds to wait before retrying a failed upload; this goes up '
+            'with each retry. (DEFAULT: %(default)s)'
+    )
+    parser.add_argument(
+        '--pair-by-header',
+        action='store_true',
+        help='Pair up the DNA and RNA BAMs by the sample name (SM tag) in the '
+            'read groups of each BAM header rather than by file name. Only the '
+            'headers are read. Samples that can not be paired up one to one '
+            'are reported and skipped.'
+    )
     parser.add_argument(
         '-d', '--dna_only', 
         action='store_true', 
@@ -217,12 +350,46 @@ def get_args():
         write_msg('err', 'You must choose a workflow with either the '
             '`--workflow` or `--CustomWorkflow` options.')
         sys.exit(1)
-    if not args.files:
+    if not args.files and not args.scan and not args.manifest:
         write_msg(
             'err',
             "You must input at least one BAM / VCF file to be processed!"
         )
         sys.exit(1)
+    if args.scan and not os.path.isdir(args.scan):
+        write_msg('err', "Scan directory '{}' does not exist!\n".format(
+            args.scan))
+        sys.exit(1)
+    if args.jobs < 1:
+        write_msg('err', 'The number of jobs must be at least 1.\n')
+        sys.exit(1)
+    if args.manifest and (args.files or args.scan or args.pair_by_header):
+        write_msg('err', "The '--manifest' option can not be used with input "
+            "files, '--scan', or '--pair-by-header'.\n")
+        sys.exit(1)
+    if args.pair_by_header and args.VCF:
+        write_msg('err', "The '--pair-by-header' option is only for BAM "
+            "files.\n")
+        sys.exit(1)
+    if args.shards and args.shard_size:
+        write_msg('err', "Only one of '--shards' and '--shard-size' can be "
+            "used.\n")
+        sys.exit(1)
+    if (args.shards is not None and args.shards < 1) or (
+            args.shard_size is not None and args.shard_size < 1):
+        write_msg('err', 'The number of shards and the shard size must be at '
+            'least 1.\n')
+        sys.exit(1)
+    if args.submit and (args.submit_jobs < 1 or args.submit_retries < 0 
+            or args.retry_delay < 0):
+        write_msg('err', 'The number of submit jobs must be at least 1, and the '
+            'retries and retry delay can not be negative.\n')
+        sys.exit(1)
+    if args.submit and args.on_exists == 'prompt':
+        # Don't leave an upload waiting on a question.
+        args.on_exists = 'fail'
+    if args.include is None:
+        args.include = ['*.vcf'] if args.VCF else ['*.bam']
 
     return args, analysis_type, ir_workflow
 
@@ -236,22 +403,14 @@ def write_msg(flag, string):
     sys.stderr.write(string)
     return
 
-def gen_sample_list(sample_data,na_types):
+def gen_sample_list(sample_data, na_types, outfile='sample.list', 
+        policy='prompt'):
     '''
     Generate the sample.list file that is used with the '-s' option of irucli
     '''
     header = ("# Sample list CSV file for IRUCLI.  Use with the '-s' option.\n# "
         "Sample_Name, Sample_Path, Gender\n")
-    outfile = 'sample.list'
-
-    if os.path.isfile(outfile):
-        write_msg('warn', "sample.list file already exists! ")
-        choice = get_choice('Do you want to overwite:')
-        if choice:
-            sys.stdout.write("Using new name: {}\n".format(choice))
-            outfile = choice
-        else:
-            sys.stdout.write("Overwriting 'sample.list'...\n")
+    outfile = check_outfile(outfile, policy)
     sys.stdout.write("Generating a sample list file '{}'...".format(outfile))
 
     with open(outfile, 'w') as fh:
@@ -262,7 +421,41 @@ def gen_sample_list(sample_data,na_types):
                     sample_data[sample]['gender'])
                 )
     sys.stdout.write('Done!\n')
-    return
+    return outfile
+
+def check_outfile(outfile, policy='prompt'):
+    '''
+    Work out what to write to if outfile already exists, by the overwrite 
+    policy; ask (like we always used to), overwrite it, use the next free 
+    numbered name (e.g. 'sample.1.list'), or stop.  Returns the file name to 
+    write to.
+    '''
+    if not os.path.isfile(outfile):
+        return outfile
+
+    if policy == 'prompt':
+        write_msg('warn', "{} file already exists! ".format(outfile))
+        choice = get_choice('Do you want to overwite:')
+        if choice:
+            sys.stdout.write("Using new name: {}\n".format(choice))
+            return choice
+        sys.stdout.write("Overwriting '{}'...\n".format(outfile))
+    elif policy == 'overwrite':
+        write_msg('warn', "Overwriting '{}'.\n".format(outfile))
+    elif policy == 'rename':
+        base, ext = os.path.splitext(outfile)
+        count = 1
+        while os.path.exists('{}.{}{}'.format(base, count, ext)):
+            count += 1
+        new_name = '{}.{}{}'.format(base, count, ext)
+        write_msg('warn', "'{}' already exists. Using new name: {}\n".format(
+            outfile, new_name))
+        return new_name
+    else:
+        write_msg('err', "'{}' already exists! Exiting so that we don't "
+            "overwrite old data.\n".format(outfile))
+        sys.exit(1)
+    return outfile
 
 def get_choice(query):
     valid_choices = {'y' : 1, 'yes' : 1, 'n' : 2, 'no' : 2, 'rename' : 3, 'r' : 3}
@@ -282,23 +475,15 @@ def get_choice(query):
         else:
             sys.stdout.write("Invalid choice '{}'!\n".format(choice))
 
-def gen_sample_meta(sample_data, workflow, na_types):
+def gen_sample_meta(sample_data, workflow, na_types, outfile='sample.meta',
+        policy='prompt'):
     '''
     Generate the sample.meta file that is used with the '--customParametersFile'
     option of irucli
     '''
     header = ("# Sample metadata file IRUCLI.  Use with the "
         "'--customParametersFile' option.\n")
-    outfile = 'sample.meta'
-
-    if os.path.isfile(outfile):
-        write_msg('warn', "sample.meta file already exists! ")
-        choice = get_choice('Do you want to overwite:')
-        if choice:
-            sys.stdout.write("Using new name: {}\n".format(choice))
-            outfile = choice
-        else:
-            sys.stdout.write("Overwriting 'sample.meta'...\n")
+    outfile = check_outfile(outfile, policy)
 
     sys.stdout.write("Generating a sample meta file '{}'...".format(outfile))
     with open(outfile, 'w') as fh:
@@ -343,7 +528,100 @@ def gen_sample_meta(sample_data, workflow, na_types):
                         )
                     )
     sys.stdout.write("Done!\n")
-    return
+    return outfile
+
+def shard_samples(sample_data, na_types, shards=None, shard_size=None):
+    '''
+    Split the samples up into shards, balanced by the total size of their 
+    files so that each upload takes about as long.  A sample (i.e. its DNA and
+    RNA files together) is never split between shards.  The biggest samples 
+    go first, each into the shard with the least data so far that still has 
+    room.  Returns a list of (sample data, total bytes) for each shard.
+    '''
+    sizes = {}
+    for sample in sample_data:
+        sizes[sample] = sum(os.stat(sample_data[sample][t]).st_size 
+            for t in na_types if t in sample_data[sample])
+
+    if shard_size:
+        count = -(-len(sizes) // shard_size)
+    else:
+        count = min(shards, len(sizes))
+    bins = [[] for i in range(count)]
+    totals = [0] * count
+    heap = [(0, i) for i in range(count)]
+    for sample in sorted(sizes, key=lambda s: sizes[s], reverse=True):
+        total, i = heapq.heappop(heap)
+        bins[i].append(sample)
+        totals[i] += sizes[sample]
+        if not shard_size or len(bins[i]) < shard_size:
+            heapq.heappush(heap, (totals[i], i))
+
+    batches = []
+    for members, total in zip(bins, totals):
+        members = set(members)
+        batches.append(({s : sample_data[s] for s in sample_data 
+            if s in members}, total))
+    return batches
+
+def run_irucli(irucli, extra_args, list_file, meta_file, retries=2, 
+        retry_delay=30):
+    '''
+    Upload one sample.list / sample.meta pair with irucli, retrying if it 
+    fails.  Everything irucli prints goes to a log file next to the 
+    sample.list, along with a line for each attempt and its exit code.  
+    Returns the sample.list, the last exit code, the number of attempts, and 
+    the log file.
+    '''
+    log_file = os.path.splitext(list_file)[0] + '.log'
+    cmd = [irucli, '-s', list_file, '--customParametersFile', meta_file]
+    cmd += extra_args
+
+    for attempt in range(1, retries + 2):
+        with open(log_file, 'a') as log:
+            log.write('## {} attempt {}: {}\n'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S'), attempt, 
+                ' '.join(shlex.quote(c) for c in cmd)))
+            log.flush()
+            try:
+                code = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log,
+                    stderr=subprocess.STDOUT).returncode
+            except OSError as e:
+                log.write('## Could not run {}: {}\n'.format(irucli, e))
+                code = 127
+            log.write('## Exit code: {}\n'.format(code))
+        if code == 0 or attempt > retries:
+            break
+        time.sleep(retry_delay * attempt)
+    return list_file, code, attempt, log_file
+
+def submit_shards(pairs, irucli, extra_args='', jobs=2, retries=2, 
+        retry_delay=30):
+    '''
+    Run irucli over each of the (sample.list, sample.meta) pairs, jobs at a 
+    time, each in its own process.  Reports on each one as it finishes, and 
+    returns the list of sample.list files that could not be uploaded.
+    '''
+    extra_args = shlex.split(extra_args)
+    failed = []
+    sys.stdout.write('Submitting {} sample list(s) with {}, {} at a '
+        'time...\n'.format(len(pairs), irucli, jobs))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(run_irucli, irucli, extra_args, list_file,
+            meta_file, retries, retry_delay) for list_file, meta_file in pairs]
+        for future in as_completed(futures):
+            list_file, code, attempts, log_file = future.result()
+            if code == 0:
+                sys.stdout.write('  OK      {} ({} attempt(s); log: {})\n'.format(
+                    list_file, attempts, log_file))
+            else:
+                write_msg('err', '{} failed with exit code {} after {} '
+                    'attempt(s); see {}\n'.format(list_file, code, attempts, 
+                    log_file))
+                failed.append(list_file)
+    sys.stdout.write('Uploaded {} of {} sample list(s).\n'.format(
+        len(pairs) - len(failed), len(pairs)))
+    return failed
 
 def validate_samples(sample_data, na_type):
     '''
@@ -390,12 +668,268 @@ def validate_samples(sample_data, na_type):
         sys.exit(1)
     return valid_samples
 
-def create_data_table(input_files, datatype, cellularity, gender, tumor_type):
+def scan_dir(top, recursive=False, patterns=None, jobs=8):
+    '''
+    Generator of the files under top whose names match one of the patterns,
+    found with os.scandir so that we don't have to stat every entry, or build
+    a giant list of paths first.  With recursive, each subdirectory is scanned
+    in its own task in a thread pool (most of the time is spent waiting on the
+    filesystem, especially over NFS), and the matches from each directory are
+    yielded as soon as it's been scanned.
+    '''
+    def scan(path):
+        files, subdirs = [], []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # Don't follow links to directories so we can't loop, but
+                    # do follow links to files, since that's how TS results 
+                    # are often laid out.
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.path)
+                    elif (entry.is_file() and (not patterns or any(
+                            fnmatch.fnmatch(entry.name, p) for p in patterns))):
+                        files.append(entry.path)
+        except OSError as e:
+            write_msg('warn', "Can not scan '{}': {}\n".format(path, e))
+        return files, subdirs
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(scan, os.path.abspath(top))}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, subdirs = future.result()
+                if recursive:
+                    pending.update(executor.submit(scan, d) for d in subdirs)
+                for path in files:
+                    yield path
+
+def read_bam_header(bam):
+    '''
+    Read just the SAM text header from the start of a BAM file; only the first
+    BGZF block or few get read and decompressed, never any of the reads.
+    '''
+    with bgzf.BgzfReader(open(bam, 'rb')) as reader:
+        if reader.read(4) != b'BAM\x01':
+            raise ValueError('not a BAM file')
+        l_text = struct.unpack('<i', reader.read(4))[0]
+        return reader.read(l_text).decode('utf-8', 'replace')
+
+def get_read_groups(header):
+    '''
+    Return a list of dicts of the tags for each @RG line in a SAM header.
+    '''
+    read_groups = []
+    for line in header.split('\n'):
+        if line.startswith('@RG\t'):
+            read_groups.append(dict(f.split(':', 1) for f in line.split('\t')[1:] 
+                if ':' in f))
+    return read_groups
+
+def header_sample(bam):
+    '''
+    Work out the sample key and nucleic acid type of a BAM from the SM tag of
+    its read groups; e.g. 'Sample1-RNA' => ('Sample1', 'RNA').  If the SM tag
+    doesn't say which type it is, or the header has no SM tag, fall back to
+    the file name for it.  Returns (key, type, note), where key is None if we
+    can't tell, and note says why (or that we fell back on the file name).
+    '''
+    name = os.path.basename(bam)
+    name_match = re.search(r'^(\w+.*?)[-_](DNA|RNA)', name)
+    note = None
+    try:
+        samples = set(rg['SM'] for rg in get_read_groups(read_bam_header(bam))
+            if rg.get('SM'))
+    except (OSError, ValueError, struct.error) as e:
+        samples = set()
+        note = "can't read the BAM header ({})".format(e)
+
+    if len(samples) > 1:
+        return None, None, 'more than one sample in the read groups ({})'.format(
+            ', '.join(sorted(samples)))
+    elif not samples:
+        if name_match is None:
+            return None, None, note or 'no SM tag in the read groups'
+        return name_match.group(1), name_match.group(2), (note or 
+            'no SM tag in the read groups') + '; paired on the file name'
+
+    sample = samples.pop()
+    match = re.search(r'^(.*?)[-_ ](DNA|RNA)$', sample, re.I)
+    if match:
+        return match.group(1), match.group(2).upper(), None
+    elif name_match:
+        return sample, name_match.group(2), None
+    return None, None, "can't tell if sample '{}' is DNA or RNA".format(sample)
+
+def pair_by_header(bams, jobs=8):
+    '''
+    Pair up the DNA and RNA BAMs by the sample in their read groups, reading
+    the headers of many files at once in a thread pool.  Builds an index of 
+    sample key to the DNA and RNA BAMs for it, and returns a dict of sample to
+    {'DNA' : bam, 'RNA' : bam} for the samples that pair up one to one.  Any 
+    BAMs that can't be placed, and samples with more than one BAM of the same 
+    type, are reported and left out.
+    '''
+    index = defaultdict(lambda: defaultdict(list))
+    problems = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for bam, (key, na_type, note) in executor.map(
+                lambda b: (b, header_sample(b)), bams):
+            if key is None:
+                write_msg('warn', "Skipping '{}': {}.\n".format(bam, note))
+                problems += 1
+                continue
+            elif note:
+                write_msg('info', "'{}': {}.\n".format(bam, note))
+            index[key][na_type].append(os.path.abspath(bam))
+
+    pairs = {}
+    for key in index:
+        if any(len(bams) > 1 for bams in index[key].values()):
+            write_msg('warn', "Ambiguous pairing for sample '{}'; skipping "
+                "it:\n".format(key))
+            for na_type in sorted(index[key]):
+                for bam in index[key][na_type]:
+                    sys.stderr.write('\t{}\t{}\n'.format(na_type, bam))
+            problems += 1
+            continue
+        pairs[key] = {t : bams[0] for t, bams in index[key].items()}
+
+    sys.stdout.write('Paired {} samples from the BAM read groups ({} '
+        'problems).\n'.format(len(pairs), problems))
+    return pairs
+
+def read_manifest(manifest, cellularity, gender, tumor_type):
+    '''
+    Build the sample table from a CSV (or TSV if it ends in .tsv or .txt) 
+    manifest with a row per file.  Rows are streamed and checked one at a 
+    time, and every problem is collected so that they can all be reported at 
+    once, rather than stopping at the first one.  Exits if there were any.
+    '''
+    aliases = {
+        'sample'      : ('sample', 'sample_name', 'pairing_key', 'key'),
+        'path'        : ('path', 'file', 'bam', 'vcf'),
+        'type'        : ('type', 'na_type', 'nucleotidetype'),
+        'cellularity' : ('cellularity', 'cellularitypct'),
+        'gender'      : ('gender',),
+        'tumor_type'  : ('cancertype', 'tumor_type', 'tumor-type'),
+    }
+    genders = {'male' : 'Male', 'female' : 'Female', 'unknown' : 'Unknown'}
+    delimiter = '\t' if manifest.endswith(('.tsv', '.txt')) else ','
     data = defaultdict(dict)
+    errors = []
+
+    try:
+        fh = open(manifest, newline='')
+    except IOError as e:
+        write_msg('err', "Can not read manifest '{}': {}\n".format(manifest, e))
+        sys.exit(1)
+
+    with fh:
+        reader = csv.reader(fh, delimiter=delimiter)
+        header = [h.strip().lower() for h in next(reader, [])]
+        cols = {}
+        for field, names in aliases.items():
+            for name in names:
+                if name in header:
+                    cols[field] = header.index(name)
+                    break
+        missing = [f for f in ('sample', 'path', 'type') if f not in cols]
+        if missing:
+            write_msg('err', "Manifest '{}' is missing the required column(s): "
+                "{}.\n".format(manifest, ', '.join(missing)))
+            sys.exit(1)
+
+        for row in reader:
+            if not any(f.strip() for f in row) or row[0].startswith('#'):
+                continue
+            line = reader.line_num
+            get = lambda f: row[cols[f]].strip() if f in cols and cols[f] < len(
+                row) else ''
+            sample, path, na_type = get('sample'), get('path'), get('type').upper()
+            row_errors = []
+
+            if not sample:
+                row_errors.append('no sample name')
+            if na_type not in ('DNA', 'RNA', 'VCF'):
+                row_errors.append("type '{}' is not DNA, RNA, or VCF".format(
+                    na_type))
+            if not path:
+                row_errors.append('no path')
+            elif not os.path.isfile(path):
+                row_errors.append("file '{}' does not exist".format(path))
+
+            values = {'cellularity' : cellularity, 'gender' : gender, 
+                'tumor_type' : tumor_type}
+            if get('cellularity'):
+                try:
+                    values['cellularity'] = int(get('cellularity'))
+                    if not 0 <= values['cellularity'] <= 100:
+                        raise ValueError
+                except ValueError:
+                    row_errors.append("cellularity '{}' is not a whole number "
+                        "from 0 to 100".format(get('cellularity')))
+            if get('gender'):
+                values['gender'] = genders.get(get('gender').lower())
+                if values['gender'] is None:
+                    row_errors.append("gender '{}' is not Male, Female, or "
+                        "Unknown".format(get('gender')))
+            if get('tumor_type'):
+                values['tumor_type'] = get('tumor_type')
 
-    if datatype == 'bam':
-        for bam in input_files:
-            sample, na_type = proc_bams(bam)
+            if not row_errors and sample in data:
+                if na_type in data[sample]:
+                    row_errors.append('sample {} already has a {} '
+                        'file'.format(sample, na_type))
+                for field in values:
+                    if data[sample][field] != values[field]:
+                        row_errors.append('{} for sample {} does not match '
+                            'its other file ({} vs {})'.format(field, sample, 
+                            values[field], data[sample][field]))
+
+            if row_errors:
+                errors.extend('line {}: {}'.format(line, e) for e in row_errors)
+                continue
+            data[sample].update(values)
+            data[sample][na_type] = os.path.abspath(path)
+
+    if errors:
+        write_msg('err', "There are {} problem(s) with the manifest '{}':"
+            "\n".format(len(errors), manifest))
+        for error in errors:
+            sys.stderr.write('\t{}\n'.format(error))
+        sys.exit(1)
+    return data
+
+def create_data_table(input_files, datatype, cellularity, gender, tumor_type,
+        pair_headers=False, jobs=8, scanned=()):
+    '''
+    Build the sample table from the input files and the scanned files, either
+    of which can be any iterable of paths (e.g. from scan_dir()) so that files
+    are added as they're found.  Sample names come from the file name, not the
+    directory it's in, unless pair_headers is set, in which case they come 
+    from the BAM headers.  Scanned BAMs with names we can't use are skipped 
+    rather than stopping the whole run, since a results tree is bound to have
+    a few (e.g. the IonXpress_001_rawlib.bam files).
+    '''
+    data = defaultdict(dict)
+
+    if datatype == 'bam' and pair_headers:
+        for sample, bams in pair_by_header(itertools.chain(input_files, 
+                scanned), jobs).items():
+            data[sample]['gender']      = gender
+            data[sample]['tumor_type']  = tumor_type
+            data[sample]['cellularity'] = cellularity
+            data[sample].update(bams)
+    elif datatype == 'bam':
+        skipped = 0
+        for bam, strict in itertools.chain(((f, True) for f in input_files), 
+                ((f, False) for f in scanned)):
+            sample, na_type = proc_bams(os.path.basename(bam), strict)
+            if sample is None:
+                skipped += 1
+                continue
             data[sample]['gender']      = gender
             data[sample]['tumor_type']  = tumor_type
             data[sample]['cellularity'] = cellularity
@@ -404,21 +938,32 @@ def create_data_table(input_files, datatype, cellularity, gender, tumor_type):
                 data[sample]['DNA'] = os.path.abspath(bam)
             else:
                 data[sample]['RNA'] = os.path.abspath(bam)
+        if skipped:
+            write_msg('warn', "Skipped {} scanned BAM(s) with names not in the "
+                "'sample_name-[DR]NA' format.\n".format(skipped))
     elif datatype == 'vcf':
-        for vcf in input_files:
-            sample = vcf.rstrip('.vcf')
+        for vcf in itertools.chain(input_files, scanned):
+            sample = os.path.basename(vcf).rstrip('.vcf')
             data[sample]['gender'] = gender
             data[sample]['tumor_type'] = tumor_type
             data[sample]['cellularity'] = cellularity
             data[sample]['VCF'] = os.path.abspath(vcf)
     return data
 
-def proc_bams(bam):
+def proc_bams(bam, strict=True):
+    '''
+    Get the sample name and NA type from the BAM name.  If the name isn't in
+    the right format, stop, or if not strict, warn and return (None, None).
+    '''
     match = re.search(r'^(\w+.*?)[-_](DNA|RNA).*', bam)
     try:
         sample = match.group(1)
         na_type = match.group(2)
     except:
+        if not strict:
+            write_msg('warn', "Skipping '{}'; can't get the sample name and "
+                "NA type from it.\n".format(bam))
+            return None, None
         write_msg(
             'err', 
             "Sample name '{}' is not well formatted! Can't create a sample.list "
@@ -431,7 +976,11 @@ def gen_setid():
     return ''.join([random.choice('0123456789abcdef') for x in range(6)])
 
 def main(input_files, dna_only, rna_only, VCF, cellularity, tumor_type, gender,
-        analysis_type, ir_workflow):
+        analysis_type, ir_workflow, pair_headers=False, jobs=8, manifest=None,
+        shards=None, shard_size=None, outdir='.', policy='prompt', scanned=()):
+    '''
+    Returns a list of the (sample.list, sample.meta) files written.
+    '''
 
     # pp(locals())
     # sys.exit()
@@ -447,18 +996,59 @@ def main(input_files, dna_only, rna_only, VCF, cellularity, tumor_type, gender,
     else: 
         rel_workflow = ['DNA','RNA']
 
-    sample_table = create_data_table(input_files, datatype, cellularity, gender,
-        tumor_type)
+    if manifest:
+        sample_table = read_manifest(manifest, cellularity, gender, tumor_type)
+    else:
+        sample_table = create_data_table(input_files, datatype, cellularity, 
+            gender, tumor_type, pair_headers, jobs, scanned)
     sample_data = validate_samples(sample_table, rel_workflow)
 
-    # Generate the 'sample.list' file
-    gen_sample_list(sample_data, rel_workflow)
+    os.makedirs(outdir, exist_ok=True)
+    if shards or shard_size:
+        batches = shard_samples(sample_data, rel_workflow, shards, shard_size)
+        names = [('sample.{:03d}.list'.format(i), 'sample.{:03d}.meta'.format(i))
+            for i in range(1, len(batches) + 1)]
+    else:
+        batches = [(sample_data, None)]
+        names = [('sample.list', 'sample.meta')]
+    names = [tuple(os.path.join(outdir, n) for n in pair) for pair in names]
+
+    if policy == 'fail':
+        # Check them all up front so we don't leave a partial set behind.
+        existing = [n for pair in names for n in pair if os.path.isfile(n)]
+        if existing:
+            write_msg('err', "Output file(s) already exist: {}. Exiting so that "
+                "we don't overwrite old data.\n".format(', '.join(existing)))
+            sys.exit(1)
+
+    written = []
+    for (batch, total), (list_file, meta_file) in zip(batches, names):
+        if total is not None:
+            sys.stdout.write('Shard {}: {} samples, {:.1f} GiB.\n'.format(
+                len(written) + 1, len(batch), total / 1024**3))
+        # Generate the 'sample.list' file
+        list_file = gen_sample_list(batch, rel_workflow, list_file, policy)
 
-    # Generate the 'sample.meta' file
-    gen_sample_meta(sample_data, ir_workflow, rel_workflow)
+        # Generate the 'sample.meta' file
+        meta_file = gen_sample_meta(batch, ir_workflow, rel_workflow, 
+            meta_file, policy)
+        written.append((list_file, meta_file))
+    return written
 
 if __name__ == '__main__':
     args, analysis_type, ir_workflow = get_args()
 
-    main(args.files, args.dna_only, args.rna_only, args.VCF, args.cellularity,
-        args.tumor_type, args.gender, analysis_type, ir_workflow)
+    scanned = ()
+    if args.scan:
+        scanned = scan_dir(args.scan, args.recursive, args.include, args.jobs)
+
+    written = main(args.files, args.dna_only, args.rna_only, args.VCF, args.cellularity,
+        args.tumor_type, args.gender, analysis_type, ir_workflow, 
+        args.pair_by_header, args.jobs, args.manifest, args.shards, 
+        args.shard_size, args.outdir, args.on_exists, scanned)
+
+    if args.submit:
+        failed = submit_shards(written, args.irucli, args.irucli_args, 
+            args.submit_jobs, args.submit_retries, args.retry_delay)
+        if failed:
+            sys.exit(1)
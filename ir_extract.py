@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+################################################################################
+"""
+In a directory of IR *download.zip files that were obtained using
+ir_api_retrieve.py, unpack each archive, and the sample archive(s) within it,
+into a subdirectory for each analysis, and collect the VCF files for each
+sample into a 'vcfs' directory for quick and easy access.  The download ZIPs
+are moved into a 'download_zips' directory once they've been unpacked.
+
+This is a replacement for the old extract_ir_data.sh script, but does it all in
+one pass over each archive, with several archives being worked on at once,
+and without needing GNU parallel or rename installed.
+"""
+import sys
+import os
+import re
+import argparse
+import errno
+import fnmatch
+import shutil
+import tempfile
+import threading
+import zipfile
+import bgzf
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from termcolor import cprint
+from pprint import pprint as pp  # noqa
+
+version = '1.3.101726'
+spool_size = 64 * 1024 * 1024
+vcf_include = ['*vcf']
+vcf_exclude = ['SmallVariants*', '*_Filtered_*']
+FICLONE = 0x40049409  # From linux/fs.h
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__)
+    parser.add_argument(
+        'zips',
+        nargs='*',
+        metavar='<download_zip>',
+        help='IR download ZIP file(s) to extract. Default is all of the '
+            '*download.zip files in the working directory.'
+    )
+    parser.add_argument(
+        '-d', '--dir',
+        metavar='<directory>',
+        default=os.getcwd(),
+        help='Directory in which to extract the data. Default: %(default)s.'
+    )
+    parser.add_argument(
+        '-i', '--include',
+        metavar='<pattern>',
+        action='append',
+        help='Only extract the files whose names match this pattern (e.g. '
+            '"*.vcf"). Can be used more than once.'
+    )
+    parser.add_argument(
+        '-e', '--exclude',
+        metavar='<pattern>',
+        action='append',
+        help='Do not extract the files whose names match this pattern. Can be '
+            'used more than once.'
+    )
+    parser.add_argument(
+        '--vcf-only',
+        action='store_true',
+        help='Only extract the VCFs that get collected into the "vcfs" '
+            'directory; same as -i "%s" -e "%s".' % ('" -i "'.join(vcf_include),
+            '" -e "'.join(vcf_exclude))
+    )
+    parser.add_argument(
+        '--bgzip',
+        action='store_true',
+        help='Also write a BGZF compressed copy of each collected VCF with a '
+            'tabix index (<vcf>.gz and <vcf>.gz.tbi), for region lookups with '
+            'bgzf.py or tabix.'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<int>',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of archives to extract at the same time. Default: '
+            '%(default)s.'
+    )
+    parser.add_argument(
+        '-q', '--quiet',
+        action='store_true',
+        help='Do not output any status information to STDOUT.'
+    )
+    parser.add_argument(
+        '-v', '--version',
+        action='version',
+        version='%(prog)s - v' + version
+    )
+    cli_args = parser.parse_args()
+
+    if cli_args.jobs < 1:
+        sys.stderr.write("ERROR: '--jobs' must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.vcf_only:
+        cli_args.include = (cli_args.include or []) + vcf_include
+        cli_args.exclude = (cli_args.exclude or []) + vcf_exclude
+    return cli_args
+
+def sample_dir_name(zip_name):
+    """
+    Get the name of the directory to unpack a sample archive into from its
+    file name, the same way the old shell script did it:
+
+        Sample_v1_c1234_2017-10-04_....zip  => Sample_v1
+        Sample_v1_1a2b3c4d-1a2b-...zip      => Sample_v1
+        Anything_else.zip                   => Anything_else
+    """
+    zip_name = os.path.basename(zip_name)
+    if re.search(r'_c[0-9]{3,}_', zip_name):
+        return re.sub(r'_c[0-9]{3,}_.*', '', zip_name)
+    elif re.search(r'_[0-9a-f]{8}-[0-9a-f]{4}', zip_name):
+        return re.sub(r'^(.*?(?:_v[0-9]+)?)_[0-9a-f]{8}-.*', r'\1', zip_name)
+    else:
+        # Need a fallback to handle all of these odd cases.
+        return zip_name.replace('.zip', '', 1)
+
+def is_wanted(path, include=None, exclude=None):
+    """
+    Check the file name (not the directory part) against the include and 
+    exclude patterns, case insensitively like 'find -iname'. Everything is
+    wanted if there aren't any patterns.
+    """
+    name = os.path.basename(path).lower()
+    if include and not any(fnmatch.fnmatchcase(name, p.lower()) 
+            for p in include):
+        return False
+    if exclude and any(fnmatch.fnmatchcase(name, p.lower()) for p in exclude):
+        return False
+    return True
+
+def is_wanted_vcf(path):
+    """
+    We want the unfiltered VCFs, and not the SmallVariants or filtered ones.
+    """
+    name = os.path.basename(path)
+    return (name.lower().endswith('vcf')
+        and not name.startswith('SmallVariants')
+        and '_Filtered_' not in name)
+
+def vcf_name(path):
+    """
+    Fix the stupid name from IR5.2 (<sample>_Non-Filtered_2017-10-04_...vcf =>
+    <sample>.vcf).
+    """
+    name = os.path.basename(path)
+    if re.search(r'_Non-Filtered_201[78]-[0-9]{2}.*vcf', name):
+        return re.sub(r'_Non-Filtered.*', '.vcf', name)
+    return name
+
+def reflink(src, dest):
+    """
+    Make dest a copy-on-write clone of src (btrfs, XFS, etc), so that it 
+    shares the data blocks rather than copying them.  Raises OSError if the 
+    filesystem (or OS) can't do that.
+    """
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'Reflinks are not supported here')
+    with open(src, 'rb') as src_fh, open(dest, 'wb') as dest_fh:
+        try:
+            fcntl.ioctl(dest_fh.fileno(), FICLONE, src_fh.fileno())
+        except OSError:
+            dest_fh.close()
+            os.remove(dest)
+            raise
+
+def collect_vcf(path, vcf_dir):
+    """
+    Put a VCF into the collected VCF directory under its trimmed name. It's
+    hard linked so that we're not writing the data out a second time, or 
+    reflinked if the filesystem can do that but won't take a hard link, and 
+    only copied if neither works (e.g. the VCF directory is on another 
+    filesystem, which reflinks can't cross either).  If there's a VCF from an
+    older analysis already there, overwrite it; we always want the latest 
+    file anyway.
+    """
+    dest = os.path.join(vcf_dir, vcf_name(path))
+    if os.path.exists(dest) and os.path.samefile(path, dest):
+        # Already linked in from an earlier run.
+        return dest
+    # Each process and thread gets its own temp name, since workers can be 
+    # collecting VCFs with the same trimmed name at the same time.
+    tmp_file = '{}.{}-{}.link'.format(dest, os.getpid(), threading.get_ident())
+    if os.path.lexists(tmp_file):
+        # Left over from a run that was killed.
+        os.remove(tmp_file)
+    try:
+        os.link(path, tmp_file)
+    except FileExistsError:
+        # Not ours to clobber with a reflink or copy.
+        raise
+    except OSError:
+        # Same filesystem but no hard links; a reflink may still work there.
+        try:
+            reflink(path, tmp_file)
+        except OSError:
+            shutil.copyfile(path, tmp_file)
+    os.replace(tmp_file, dest)
+    return dest
+
+def extract_sample(archive, outdir, vcf_dir, include=None, exclude=None,
+        bgzip=False):
+    """
+    Unpack one sample archive (a path or file object) into outdir, collecting
+    the VCFs as we go (and writing a BGZF copy with a tabix index alongside 
+    each collected VCF if bgzip is set). Only the members that pass the 
+    include and exclude patterns are extracted; the rest are skipped without
+    being decompressed. Returns a list of the VCFs collected.
+    """
+    vcfs = []
+    with zipfile.ZipFile(archive) as zfh:
+        for member in zfh.infolist():
+            if member.is_dir():
+                # The directories that hold what we want get made along with
+                # it, so we only need these when we're taking everything.
+                if include or exclude:
+                    continue
+            elif not is_wanted(member.filename, include, exclude):
+                continue
+            path = zfh.extract(member, outdir)
+            if not member.is_dir() and is_wanted_vcf(path):
+                vcfs.append(collect_vcf(path, vcf_dir))
+                if bgzip:
+                    bgzf.compress_vcf(vcfs[-1])
+    return vcfs
+
+def extract_download(download, outdir, vcf_dir, include=None, exclude=None,
+        bgzip=False):
+    """
+    Unpack an IR download ZIP (a path or file object) into outdir in one pass.
+    The sample archives within it go into a directory for each sample, and are
+    read straight out of the download ZIP (spooled to a temp file if they're
+    big, since zipfile needs to seek around in them) rather than being written
+    out and unzipped again. Log files are skipped, and anything else is put in
+    outdir as is.  
+
+    The include and exclude patterns are checked against the files in the 
+    sample archives, and anything else in the download ZIP other than the 
+    sample archives themselves; only what's wanted is written out.  Each 
+    sample archive is still inflated in full to get at its members, but the 
+    members that aren't wanted are not decompressed in turn.  Returns a list 
+    of (sample name, [collected VCFs]).
+    """
+    samples = []
+    with zipfile.ZipFile(download) as outer:
+        for member in outer.infolist():
+            if member.is_dir() or member.filename.endswith('log'):
+                continue
+            if not member.filename.lower().endswith('.zip'):
+                if is_wanted(member.filename, include, exclude):
+                    outer.extract(member, outdir)
+                continue
+
+            name = sample_dir_name(member.filename)
+            with outer.open(member) as src, \
+                    tempfile.SpooledTemporaryFile(spool_size, dir=outdir) as tmp:
+                shutil.copyfileobj(src, tmp, 1024 * 1024)
+                tmp.seek(0)
+                vcfs = extract_sample(tmp, os.path.join(outdir, name), vcf_dir,
+                    include, exclude, bgzip)
+            samples.append((name, vcfs))
+    return samples
+
+def extract_file(zip_file, outdir, include=None, exclude=None, bgzip=False):
+    """
+    Worker for the process pool; unpack a download ZIP file, and move it into
+    the download_zips directory when we're done with it. Returns the ZIP name,
+    the samples from extract_download(), and an error message or None.
+    """
+    try:
+        samples = extract_download(zip_file, outdir, os.path.join(outdir,
+            'vcfs'), include, exclude, bgzip)
+    except (zipfile.BadZipFile, OSError, ValueError) as error:
+        return zip_file, [], str(error)
+    os.replace(zip_file, os.path.join(outdir, 'download_zips',
+        os.path.basename(zip_file)))
+    return zip_file, samples, None
+
+def make_dir(path, label, quiet):
+    if not os.path.isdir(path):
+        if quiet is False:
+            sys.stdout.write("\tNo '{}' directory found. Creating new.\n".format(
+                label))
+        os.makedirs(path)
+        return False
+    return True
+
+def main():
+    cli_args = get_args()
+    quiet = cli_args.quiet
+    outdir = os.path.abspath(cli_args.dir)
+
+    if cli_args.zips:
+        zips = [os.path.abspath(z) for z in cli_args.zips]
+    else:
+        zips = sorted(os.path.join(outdir, f) for f in os.listdir(outdir)
+            if f.lower().endswith('download.zip'))
+    if not zips:
+        sys.stderr.write("ERROR: No IR API *download.zip file(s) can be found "
+            "in {}!\n".format(outdir))
+        sys.exit(1)
+
+    make_dir(os.path.join(outdir, 'download_zips'), 'download_zips', quiet)
+    vcf_dir = os.path.join(outdir, 'vcfs')
+    if (make_dir(vcf_dir, 'vcfs', quiet) and quiet is False
+            and any(f.endswith('vcf') for f in os.listdir(vcf_dir))):
+        cprint("\tWARN: There are VCF files already in the 'vcfs' directory "
+            "which may be overwritten by newer versions!", 'yellow',
+            file=sys.stderr)
+
+    if quiet is False:
+        sys.stdout.write('Extracting {} IR archive(s) using {} job(s)...\n'.format(
+            len(zips), min(cli_args.jobs, len(zips))))
+        sys.stdout.flush()
+
+    failed = []
+    total_vcfs = 0
+    with ProcessPoolExecutor(max_workers=min(cli_args.jobs, len(zips))) as pool:
+        futures = [pool.submit(extract_file, z, outdir, cli_args.include,
+            cli_args.exclude, cli_args.bgzip) for z in zips]
+        for future in as_completed(futures):
+            zip_file, samples, error = future.result()
+            if error:
+                cprint('\tERROR: There was a problem extracting {}: {}'.format(
+                    os.path.basename(zip_file), error), 'red', attrs=['bold'],
+                    file=sys.stderr)
+                failed.append(zip_file)
+                continue
+            for name, vcfs in samples:
+                total_vcfs += len(vcfs)
+                if quiet is False:
+                    sys.stdout.write('\t Processed {} ({} VCF).\n'.format(name,
+                        len(vcfs)))
+            sys.stdout.flush()
+
+    if quiet is False:
+        sys.stdout.write('Done! Extracted {} of {} archive(s), and collected {} '
+            'VCF file(s) into {}.\n'.format(len(zips) - len(failed), len(zips),
+            total_vcfs, vcf_dir))
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
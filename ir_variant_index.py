@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+################################################################################
+"""
+Build a compact index of all of the variant calls in a directory of collected
+VCFs (i.e. the 'vcfs' directory from ir_extract.py), and look up calls across
+the whole cohort by position, gene, or sample without having to read all of
+the VCFs again.
+
+The index is a set of NumPy arrays (chrom, pos, end, ref, alt, gene, sample, 
+and whether the call passed filters) kept sorted by position, saved in a .npz file
+in the VCF directory.  Each run only reads the VCFs that are new or have
+changed since the index was last updated, and drops the calls of any that are
+gone.  Queries can be combined, e.g.:
+
+    ir_variant_index.py --gene EGFR --sample Sample1
+    ir_variant_index.py --region chr7:55249071
+"""
+import sys
+import os
+import re
+import argparse
+import gzip
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from bgzf import parse_region, record_span
+from pprint import pprint as pp  # noqa
+
+version = '1.0.101726'
+index_name = 'cohort_index.npz'
+tables = ('samples', 'chroms', 'alleles', 'genes')
+columns = ('chrom', 'pos', 'end', 'ref', 'alt', 'gene', 'sample', 'passed')
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description = __doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-d', '--dir',
+        metavar='<vcf_dir>',
+        default='vcfs',
+        help='Directory of collected VCFs to index. Default: %(default)s.'
+    )
+    parser.add_argument(
+        '-I', '--index',
+        metavar='<npz_file>',
+        help='Index file to use. Default: "{}" in the VCF '
+            'directory.'.format(index_name)
+    )
+    parser.add_argument(
+        '-n', '--no-update',
+        action='store_true',
+        help='Query the index as it is, without checking the VCF directory for '
+            'new or changed VCFs first.'
+    )
+    parser.add_argument(
+        '-r', '--region',
+        metavar='<chr:beg-end>',
+        help='Only show calls in this region or at this position (1-based, '
+            'inclusive).'
+    )
+    parser.add_argument(
+        '-g', '--gene',
+        metavar='<gene>',
+        help='Only show calls in this gene (or fusions involving it).'
+    )
+    parser.add_argument(
+        '-s', '--sample',
+        metavar='<sample>',
+        help='Only show calls from this sample.'
+    )
+    parser.add_argument(
+        '-p', '--pass-only',
+        action='store_true',
+        help='Only show calls that passed filters.'
+    )
+    parser.add_argument(
+        '-l', '--list-samples',
+        action='store_true',
+        help='Just list the samples that have calls matching the query, and '
+            'how many.'
+    )
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='<int>',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of VCFs to read at the same time when updating the '
+            'index. Default: %(default)s.'
+    )
+    parser.add_argument(
+        '-q', '--quiet',
+        action='store_true',
+        help='Do not output any status information.'
+    )
+    parser.add_argument(
+        '-v', '--version',
+        action='version',
+        version='%(prog)s - v' + version
+    )
+    cli_args = parser.parse_args()
+
+    if cli_args.jobs < 1:
+        sys.stderr.write("ERROR: '--jobs' must be at least 1.\n")
+        sys.exit(1)
+    if cli_args.region:
+        try:
+            chrom, beg, end = parse_region(cli_args.region)
+            if ':' in cli_args.region and '-' not in cli_args.region:
+                # Just the one position, rather than from there on like 
+                # samtools does it.
+                end = beg + 1
+            cli_args.region = (chrom, beg, end)
+        except ValueError as error:
+            sys.stderr.write('ERROR: {}\n'.format(error))
+            sys.exit(1)
+    if cli_args.index is None:
+        cli_args.index = os.path.join(cli_args.dir, index_name)
+    return cli_args
+
+def get_genes(info):
+    """
+    Pull the gene name(s) out of the INFO field; from the FUNC annotations for
+    SNVs / indels, or GENE_NAME for fusions and CNVs.  More than one gets
+    joined with '|'.
+    """
+    genes = re.findall(r"'gene':'([^']+)'", info)
+    genes += re.findall(r'(?:^|;)GENE_NAME=([^;]+)', info)
+    return '|'.join(sorted(set(g for gene in genes for g in gene.split(','))))
+
+def read_vcf(vcf):
+    """
+    Worker for the process pool; read the calls out of a VCF.  Returns a list
+    of (chrom, pos, end, ref, alt, gene, passed) for each record that has an 
+    ALT allele, where end is the (0-based, exclusive) end of the call from 
+    bgzf.record_span(), so that CNVs and fusions cover their whole span.
+    """
+    rows = []
+    opener = gzip.open if vcf.endswith('.gz') else open
+    with opener(vcf, 'rt') as fh:
+        for line in fh:
+            if line.startswith('#'):
+                continue
+            fields = line.rstrip('\n').split('\t', 8)
+            if len(fields) < 8 or fields[4] == '.':
+                continue
+            rows.append((fields[0], int(fields[1]), record_span(fields)[1], 
+                fields[3], fields[4], get_genes(fields[7]), 
+                fields[6] in ('PASS', '.')))
+    return rows
+
+def find_vcfs(vcf_dir):
+    """
+    Return a dict of sample name to VCF for the VCFs in the directory, using
+    the plain VCF over the BGZF copy if we have both.
+    """
+    vcfs = {}
+    for name in sorted(os.listdir(vcf_dir)):
+        for ext in ('.vcf', '.vcf.gz'):
+            if name.endswith(ext):
+                vcfs.setdefault(name[:-len(ext)], os.path.join(vcf_dir, name))
+    return vcfs
+
+def empty_index():
+    index = {t : np.array([], dtype=str) for t in tables}
+    index['sizes'] = np.array([], dtype=np.int64)
+    index['mtimes'] = np.array([], dtype=np.float64)
+    for col in columns:
+        index[col] = np.array([], dtype=bool if col == 'passed' else np.int64)
+    return index
+
+def load_index(index_file):
+    if not os.path.isfile(index_file):
+        return empty_index()
+    with np.load(index_file) as data:
+        if any(col not in data.files for col in columns):
+            # From an older version; build it again.
+            return empty_index()
+        return {key : data[key] for key in data.files}
+
+def save_index(index, index_file):
+    tmp_file = index_file + '.tmp.npz'
+    np.savez(tmp_file, **index)
+    os.replace(tmp_file, index_file)
+
+def encode(values, table):
+    """
+    Dictionary encode a list of strings against table (a list, which gets any
+    new values added to it). Returns an array of the ids.
+    """
+    lookup = {v : i for i, v in enumerate(table)}
+    ids = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        if value not in lookup:
+            lookup[value] = len(table)
+            table.append(value)
+        ids[i] = lookup[value]
+    return ids
+
+def update_index(index, vcf_dir, jobs, quiet=False):
+    """
+    Bring the index up to date with the VCFs in vcf_dir; keep the calls of the
+    samples whose VCF hasn't changed (same size and mtime), drop those that
+    have changed or are gone, and read in the new and changed ones.  Returns
+    the updated index, or None if nothing changed.
+    """
+    vcfs = find_vcfs(vcf_dir)
+    stats = {name : os.stat(vcf) for name, vcf in vcfs.items()}
+    old = {name : i for i, name in enumerate(index['samples'])}
+
+    keep = [name for name in old if name in stats
+        and stats[name].st_size == index['sizes'][old[name]]
+        and stats[name].st_mtime == index['mtimes'][old[name]]]
+    todo = [name for name in vcfs if name not in set(keep)]
+    removed = [name for name in old if name not in stats]
+    if not todo and not removed:
+        return None
+    if quiet is False:
+        sys.stderr.write('Reading {} new or changed VCF(s) ({} unchanged, {} '
+            'removed)...\n'.format(len(todo), len(keep), len(removed)))
+
+    # Renumber the samples we're keeping so the ids stay contiguous.
+    remap = np.full(len(old), -1, dtype=np.int64)
+    for new_id, name in enumerate(keep):
+        remap[old[name]] = new_id
+    rows = remap[index['sample']] >= 0
+    new = {col : index[col][rows] for col in columns}
+    new['sample'] = remap[new['sample']]
+
+    samples = keep + todo
+    tbl = {t : list(index[t]) for t in ('chroms', 'alleles', 'genes')}
+    parts = [new]
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        for sample_id, records in enumerate(pool.map(read_vcf,
+                [vcfs[name] for name in todo]), len(keep)):
+            if not records:
+                continue
+            chrom, pos, end, ref, alt, gene, passed = zip(*records)
+            parts.append({
+                'chrom'  : encode(chrom, tbl['chroms']),
+                'pos'    : np.array(pos, dtype=np.int64),
+                'end'    : np.array(end, dtype=np.int64),
+                'ref'    : encode(ref, tbl['alleles']),
+                'alt'    : encode(alt, tbl['alleles']),
+                'gene'   : encode(gene, tbl['genes']),
+                'sample' : np.full(len(records), sample_id, dtype=np.int64),
+                'passed' : np.array(passed, dtype=bool),
+            })
+
+    updated = {col : np.concatenate([p[col] for p in parts]) for col in columns}
+    order = np.lexsort((updated['pos'], updated['chrom']))
+    updated = {col : updated[col][order] for col in columns}
+    updated['samples'] = np.array(samples, dtype=str)
+    updated['sizes'] = np.array([stats[s].st_size for s in samples],
+        dtype=np.int64)
+    updated['mtimes'] = np.array([stats[s].st_mtime for s in samples],
+        dtype=np.float64)
+    for t in tbl:
+        updated[t] = np.array(tbl[t], dtype=str)
+    return updated
+
+def query_index(index, region=None, gene=None, sample=None, pass_only=False):
+    """
+    Return the row numbers of the calls matching all of the query terms. The
+    rows are sorted by chrom and position, so a region is just a slice.
+    """
+    rows = np.arange(len(index['pos']))
+    if region is not None:
+        chrom, beg, end = region
+        chrom_ids = np.nonzero(index['chroms'] == chrom)[0]
+        if not len(chrom_ids):
+            return rows[:0]
+        lo, hi = np.searchsorted(index['chrom'], [chrom_ids[0],
+            chrom_ids[0] + 1])
+        pos = index['pos'][lo:hi]
+        ends = index['end'][lo:hi]
+
+        # Calls that start up to the longest span (REF, or to INFO END for 
+        # CNVs and the like) before beg can still overlap it, so start looking
+        # there and then check each one.
+        first = np.searchsorted(pos, beg + 2 - (ends - pos + 1).max(initial=1))
+        last = np.searchsorted(pos, end, side='right')
+        span = slice(first, last)
+        rows = rows[lo:hi][span][ends[span] > beg]
+    if gene is not None:
+        gene_ids = [i for i, g in enumerate(index['genes'])
+            if gene in g.split('|')]
+        rows = rows[np.isin(index['gene'][rows], gene_ids)]
+    if sample is not None:
+        sample_ids = np.nonzero(index['samples'] == sample)[0]
+        rows = rows[np.isin(index['sample'][rows], sample_ids)]
+    if pass_only:
+        rows = rows[index['passed'][rows]]
+    return rows
+
+def main():
+    cli_args = get_args()
+    quiet = cli_args.quiet
+
+    if not os.path.isdir(cli_args.dir) and not cli_args.no_update:
+        sys.stderr.write("ERROR: No VCF directory '{}' found!\n".format(
+            cli_args.dir))
+        sys.exit(1)
+
+    index = load_index(cli_args.index)
+    if not cli_args.no_update:
+        updated = update_index(index, cli_args.dir, cli_args.jobs, quiet)
+        if updated is not None:
+            index = updated
+            save_index(index, cli_args.index)
+    if quiet is False:
+        sys.stderr.write('Index {} has {} calls from {} samples.\n'.format(
+            cli_args.index, len(index['pos']), len(index['samples'])))
+
+    if not (cli_args.region or cli_args.gene or cli_args.sample
+            or cli_args.list_samples):
+        return
+
+    rows = query_index(index, cli_args.region, cli_args.gene, cli_args.sample,
+        cli_args.pass_only)
+    if cli_args.list_samples:
+        ids, counts = np.unique(index['sample'][rows], return_counts=True)
+        for sample_id, count in zip(ids, counts):
+            sys.stdout.write('{}\t{}\n'.format(index['samples'][sample_id],
+                count))
+        return
+
+    sys.stdout.write('Sample\tChrom\tPos\tRef\tAlt\tGene\tFilter\n')
+    for row in rows:
+        sys.stdout.write('\t'.join([
+            index['samples'][index['sample'][row]],
+            index['chroms'][index['chrom'][row]],
+            str(index['pos'][row]),
+            index['alleles'][index['ref'][row]],
+            index['alleles'][index['alt'][row]],
+            index['genes'][index['gene'][row]],
+            'PASS' if index['passed'][row] else 'FAIL',
+        ]) + '\n')
+
+if __name__ == '__main__':
+    main()